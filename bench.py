@@ -0,0 +1,456 @@
+import cgi
+import json
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+import notes2html
+from notes2html import IMG_EXTENSIONS, TEMPLATES, build, build_note, classify_line, convert_note, escape, find_notes, get_out_file, get_title, make_out_dir, parse, render_body, render_sections, render_template, scan_notes
+
+KB = 1024
+MB = 1024 * KB
+SIZES = [KB, 10 * KB, 100 * KB, MB, 10 * MB, 50 * MB]
+REGRESSION_THRESHOLD = 0.1
+
+
+def code_heavy_note(size):
+    lines = ['*code dump*\n', 'section\n', '    *start of the dump\n']
+    written = sum(len(line) for line in lines)
+    i = 0
+    while written < size:
+        line = '    for (int i = 0; i < %d; i++) { total += values[i] & mask; }\n' % i
+        lines.append(line)
+        written += len(line)
+        i += 1
+    lines.append('    end of the dump*\n')
+    return lines
+
+
+def many_sections_note(size, section, entries):
+    lines = ['*generated note*\n']
+    written = len(lines[0])
+    i = 0
+    while written < size:
+        for line in section(i) + [entry(i, j) for j, entry in enumerate(entries)]:
+            lines.append(line)
+            written += len(line)
+        i += 1
+    return lines
+
+
+def small_note(size):
+    return many_sections_note(size, lambda i: ['topic %d\n' % i], [
+        lambda i, j: '    short entry %d with **bold** text\n' % i,
+    ])
+
+
+def narrative_note(size):
+    lines = many_sections_note(size, lambda i: ['chapter %d\n' % i], [
+        lambda i, j: '    It was a long paragraph number %d, written in plain prose & meant to be read.\n' % i,
+        lambda i, j: '    A second paragraph quotes \\*literally\\* and **stresses** a point.\n',
+    ])
+    lines[0] = '*generated note*narrative\n'
+    return lines
+
+
+def nested_note(size):
+    return many_sections_note(size, lambda i: ['topic %d\n' % i], [
+        lambda i, j: '    entry %d\n' % i,
+        lambda i, j: '        nested detail of entry %d\n' % i,
+        lambda i, j: '        another nested detail\n',
+    ])
+
+
+def image_heavy_note(size):
+    return many_sections_note(size, lambda i: ['gallery %d\n' % i], [
+        lambda i, j: '    #screenshot-%d.png#\n' % i,
+        lambda i, j: '    caption for screenshot %d\n' % i,
+    ])
+
+
+# name -> (note generator, number of notes, bytes per note)
+CORPORA = [
+    ('many_small', small_note, 2000, KB),
+    ('few_huge', code_heavy_note, 2, 8 * MB),
+    ('code_heavy', code_heavy_note, 50, 100 * KB),
+    ('narrative', narrative_note, 200, 20 * KB),
+    ('nested', nested_note, 200, 20 * KB),
+    ('image_heavy', image_heavy_note, 200, 20 * KB),
+]
+
+
+def synthetic_lines(count):
+    samples = [
+        'plain text without any markup at all\n',
+        'use **nmap -sV** and then **nikto -h host** on <target>\n',
+        'escaped \\*star\\* & an ampersand\n',
+        'if (a < b && c > d) { return *ptr; }\n',
+    ]
+    return [samples[i % len(samples)] for i in range(count)]
+
+
+def nested_lines(count):
+    samples = [
+        'section title\n',
+        '    entry with some words in it\n',
+        '        nested entry with a few more words\n',
+        '\t   entry indented with a tab\n',
+        '    #diagram.png#\n',
+        '    *single line of code*\n',
+    ]
+    return [samples[i % len(samples)] for i in range(count)]
+
+
+def legacy_escape(line):
+    line = cgi.escape(line)
+    while re.search(r'\*\*(.*?)\*\*', line):
+        line = re.sub(r'\*\*(.*?)\*\*', '<strong>\\1</strong>', line.replace('\n', ''))
+    line = re.sub(r'\\\*', '*', line.replace('\n', ''))
+    return line
+
+
+def legacy_classify(line, current_level):
+    line = line.replace('\t\t\t', '         ').replace('\t\t', '     ').replace('\t', ' ').replace('\n', '')
+    if line == '' and current_level != 'code':
+        return None
+    next_level = None
+    if current_level != 'code':
+        spaces = 0
+        for c in line:
+            if c == ' ':
+                spaces += 1
+            else:
+                break
+        next_level = {0: 'first_level', 4: 'second_level', 8: 'third_level'}[spaces]
+        line = line[spaces:]
+    if line.startswith('#') and line.endswith('#') and any(line[1:-1].endswith(extension) for extension in IMG_EXTENSIONS):
+        return next_level, 'image', line
+    if current_level == 'code' and line.endswith('*'):
+        return next_level, 'code_end', line
+    if current_level == 'code':
+        return next_level, 'code', line
+    if line.startswith('*') and not line.startswith('**') and not re.match('^\*[a-zA-Z0-9<>;&]+\*', line):
+        return next_level, 'code_start', line
+    return next_level, 'text', line
+
+
+def read_corpus(src_dir):
+    lines = []
+    for a_file in find_notes(src_dir):
+        with open(a_file) as read:
+            lines.extend(read.readlines())
+    return lines
+
+
+def bench_render_scaling(sizes):
+    print '%12s %12s %12s' % ('bytes', 'seconds', 'us/KB')
+    for size in sizes:
+        lines = code_heavy_note(size)
+        seconds = min(timeit.repeat(lambda: parse(lines), number=1, repeat=3 if size <= MB else 1))
+        print '%12d %12.4f %12.2f' % (size, seconds, seconds * 1e6 / (size / float(KB)))
+
+
+def bench_escape(lines):
+    for line in lines:
+        if legacy_escape(line) != escape(line):
+            raise Exception('escape() differs from legacy_escape() for line [%s]' % line)
+    print '%12s %12s %12s' % ('function', 'seconds', 'ns/line')
+    for name, function in [('legacy', legacy_escape), ('escape', escape)]:
+        seconds = min(timeit.repeat(lambda: [function(line) for line in lines], number=1, repeat=5))
+        print '%12s %12.4f %12.1f' % (name, seconds, seconds * 1e9 / len(lines))
+
+
+def write_corpus(src_dir, generator, count, size):
+    for i in range(count):
+        with open(os.path.join(src_dir, 'note%05d.txt' % i), 'w') as write:
+            write.writelines(generator(size))
+
+
+def bench_corpus(name, generator, count, size, results):
+    src_dir = tempfile.mkdtemp()
+    dst_dir = tempfile.mkdtemp()
+    try:
+        write_corpus(src_dir, generator, count, size)
+        notes = []
+        for a_file in find_notes(src_dir):
+            with open(a_file) as read:
+                notes.append(read.readlines())
+        lines = sum(len(note) for note in notes)
+        size_in = sum(len(line) for note in notes for line in note)
+
+        start = time.time()
+        for note in notes:
+            parse(note)
+        parse_seconds = time.time() - start
+        del notes
+
+        start = time.time()
+        build(src_dir, dst_dir, {})
+        run_seconds = time.time() - start
+
+        results.put({
+            'corpus': name,
+            'notes': count,
+            'lines': lines,
+            'bytes': size_in,
+            'parse_seconds': parse_seconds,
+            'parse_lines_per_second': lines / parse_seconds,
+            'parse_mb_per_second': size_in / parse_seconds / MB,
+            'run_seconds': run_seconds,
+            'run_lines_per_second': lines / run_seconds,
+            'run_mb_per_second': size_in / run_seconds / MB,
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        })
+    finally:
+        shutil.rmtree(src_dir)
+        shutil.rmtree(dst_dir)
+
+
+def bench_suite(scale, output, baseline):
+    results = []
+    print '%12s %8s %10s %12s %10s %12s %10s %10s' % ('corpus', 'notes', 'MB', 'parse l/s', 'parse MB/s', 'run l/s', 'run MB/s', 'RSS KB')
+    for name, generator, count, size in CORPORA:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=bench_corpus, args=(name, generator, count, int(size * scale), queue))
+        process.start()
+        result = queue.get()
+        process.join()
+        results.append(result)
+        print '%12s %8d %10.1f %12d %10.2f %12d %10.2f %10d' % (
+            name, result['notes'], result['bytes'] / float(MB), result['parse_lines_per_second'],
+            result['parse_mb_per_second'], result['run_lines_per_second'], result['run_mb_per_second'], result['peak_rss_kb'])
+
+    if output is not None:
+        with open(output, 'w') as write:
+            json.dump({'scale': scale, 'results': results}, write, indent=2, sort_keys=True)
+    if baseline is not None:
+        return compare_results(baseline, results)
+    return 0
+
+
+def compare_results(baseline, results):
+    with open(baseline) as read:
+        previous = dict((result['corpus'], result) for result in json.load(read)['results'])
+    regressions = 0
+    for result in results:
+        old = previous.get(result['corpus'])
+        if old is None:
+            continue
+        for metric in ['parse_mb_per_second', 'run_mb_per_second']:
+            change = result[metric] / old[metric] - 1
+            if change < -REGRESSION_THRESHOLD:
+                print 'Regression in %s %s: %.2f -> %.2f (%+.0f%%)' % (result['corpus'], metric, old[metric], result[metric], change * 100)
+                regressions += 1
+    return 1 if regressions else 0
+
+
+def get_flag(argv, flag, default=None):
+    if flag in argv:
+        return argv[argv.index(flag) + 1]
+    return default
+
+
+def bench_templates(sizes):
+    print '%12s %12s %12s' % ('bytes', 'legacy %', 'template')
+    for size in sizes:
+        lines = nested_note(size)
+        title = get_title(lines)
+        html = []
+        toc = []
+        render_sections(build_note(lines)[2], title['is_narrative'], html.extend, toc, None)
+        with open(os.devnull, 'w') as write:
+            legacy = min(timeit.repeat(lambda: write.write(render_template(TEMPLATES['body'], {'title': title['value'], 'toc': ''.join(toc), 'body': ''.join(html), 'stylesheet': '/assets/main.css', 'favicon': '/assets/favicon.png', 'script': '/assets/syntaxhighlighter.js'})), number=1, repeat=3))
+            template = min(timeit.repeat(lambda: write.writelines(render_body(title['value'], toc, html)), number=1, repeat=3))
+        print '%12d %12.4f %12.4f' % (size, legacy, template)
+
+
+def is_classifiable(line):
+    try:
+        classify_line(line, False)
+    except Exception:
+        return False
+    return True
+
+
+def bench_classify(lines):
+    lines = [line for line in lines if is_classifiable(line)]
+    print '%12s %12s %12s' % ('function', 'seconds', 'ns/line')
+    for name, function in [('legacy', lambda line: legacy_classify(line, 'text')), ('classify', lambda line: classify_line(line, False))]:
+        seconds = min(timeit.repeat(lambda: [function(line) for line in lines], number=1, repeat=5))
+        print '%12s %12.4f %12.1f' % (name, seconds, seconds * 1e9 / len(lines))
+
+
+def write_code_dump(path, size):
+    with open(path, 'w') as write:
+        write.write('*code dump*\nsection\n    *start of the dump\n')
+        written = 0
+        i = 0
+        while written < size:
+            block = ''.join('    for (int i = 0; i < %d; i++) { total += values[i] & mask; }\n' % j for j in range(i, i + 1000))
+            write.write(block)
+            written += len(block)
+            i += 1000
+        write.write('    end of the dump*\n')
+
+
+def convert_in_mode(mode, a_file, out_file, results):
+    start = time.time()
+    if mode == 'readlines':
+        with open(a_file) as read:
+            lines = read.readlines()
+        with open(out_file, 'w') as write:
+            write.write(parse(lines))
+        del lines
+    else:
+        job = {'file': a_file, 'out_file': out_file, 'known_hash': None, 'stat_unchanged': False, 'stale': False, 'ast_cache': None, 'outline': False,
+               'profile': False, 'compress': False, 'src_dir': os.path.dirname(a_file), 'pipeline': False, 'source': None}
+        if convert_note(job)['error'] is not None:
+            raise Exception('Failed to convert [%s]' % a_file)
+    results.put((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def bench_memory(size):
+    work_dir = tempfile.mkdtemp()
+    try:
+        a_file = os.path.join(work_dir, 'dump.txt')
+        write_code_dump(a_file, size)
+        print '%12s %12s %12s' % ('input', 'seconds', 'peak RSS KB')
+        for mode in ['readlines', 'stream']:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=convert_in_mode, args=(mode, a_file, os.path.join(work_dir, mode + '.html'), queue))
+            process.start()
+            seconds, peak_rss = queue.get()
+            process.join()
+            print '%12s %12.2f %12d' % (mode, seconds, peak_rss)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def write_tree(src_dir, count, per_dir=100):
+    for i in range(count):
+        directory = os.path.join(src_dir, 'dir%04d' % (i // per_dir))
+        if i % per_dir == 0:
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'note%06d.txt' % i), 'w') as write:
+            write.write('*note*\n')
+
+
+def legacy_scan(src_dir, dst_dir):
+    a_files = sorted(os.path.join(dp, f) for dp, dn, filenames in os.walk(src_dir) for f in filenames if os.path.splitext(f)[1] == '.txt')
+    for a_file in a_files:
+        os.stat(a_file)
+        make_out_dir(get_out_file(a_file, src_dir, dst_dir))
+
+
+def scan(src_dir, dst_dir):
+    out_dirs = set()
+    for a_file, stat_result in scan_notes(src_dir, True):
+        out_file = get_out_file(a_file, src_dir, dst_dir)
+        out_dir = out_file[:out_file.rindex('/')]
+        if out_dir not in out_dirs:
+            out_dirs.add(out_dir)
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+
+
+def count_os_calls(function, *args):
+    counts = {}
+    originals = dict((name, getattr(os, name)) for name in ['stat', 'lstat', 'listdir', 'mkdir'])
+
+    def counted(name):
+        def call(*call_args):
+            counts[name] = counts.get(name, 0) + 1
+            return originals[name](*call_args)
+        return call
+    for name in originals:
+        setattr(os, name, counted(name))
+    try:
+        function(*args)
+    finally:
+        for name, original in originals.items():
+            setattr(os, name, original)
+    return sum(counts.values())
+
+
+def bench_scan(count):
+    src_dir = tempfile.mkdtemp()
+    available = notes2html.scandir
+    try:
+        write_tree(src_dir, count)
+        print '%12s %12s %12s' % ('scanner', 'seconds', 'os calls')
+        for name, function, scandir in [('legacy', legacy_scan, available), ('listdir', scan, None), ('scandir', scan, available)]:
+            if name == 'scandir' and available is None:
+                continue
+            notes2html.scandir = scandir
+            dst_dir = tempfile.mkdtemp()
+            calls = count_os_calls(function, src_dir, dst_dir)
+            shutil.rmtree(dst_dir)
+            dst_dir = tempfile.mkdtemp()
+            seconds = min(timeit.repeat(lambda: function(src_dir, dst_dir), number=1, repeat=3))
+            shutil.rmtree(dst_dir)
+            print '%12s %12.4f %12d' % (name, seconds, calls)
+    finally:
+        notes2html.scandir = available
+        shutil.rmtree(src_dir)
+
+
+def slow_open(delay):
+    def open_with_delay(*args, **kwargs):
+        time.sleep(delay)
+        return open(*args, **kwargs)
+    return open_with_delay
+
+
+def time_build(src_dir, options):
+    dst_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        build(src_dir, dst_dir, options)
+        return time.time() - start
+    finally:
+        shutil.rmtree(dst_dir)
+
+
+def bench_pipeline(count, delay_ms):
+    src_dir = tempfile.mkdtemp()
+    try:
+        write_corpus(src_dir, small_note, count, 4 * KB)
+        print '%12s %12s %12s' % ('build', 'seconds', 'notes/s')
+        notes2html.open = slow_open(delay_ms / 1000.0)
+        for name, options in [('sequential', {}), ('pipeline', {'pipeline': True})]:
+            seconds = min(time_build(src_dir, options) for i in range(3))
+            print '%12s %12.4f %12.1f' % (name, seconds, count / seconds)
+    finally:
+        del notes2html.open
+        shutil.rmtree(src_dir)
+
+
+def main(argv):
+    if argv[:1] == ['suite']:
+        sys.exit(bench_suite(float(get_flag(argv, '--scale', 1)), get_flag(argv, '--output'), get_flag(argv, '--baseline')))
+    elif argv[:1] == ['templates']:
+        bench_templates([int(size) for size in argv[1:]] or SIZES)
+    elif argv[:1] == ['classify']:
+        bench_classify(read_corpus(argv[1]) if len(argv) > 1 else nested_lines(200000))
+    elif argv[:1] == ['escape']:
+        bench_escape(read_corpus(argv[1]) if len(argv) > 1 else synthetic_lines(200000))
+    elif argv[:1] == ['scan']:
+        bench_scan(int(argv[1]) if len(argv) > 1 else 100000)
+    elif argv[:1] == ['pipeline']:
+        bench_pipeline(int(argv[1]) if len(argv) > 1 else 2000, float(argv[2]) if len(argv) > 2 else 2)
+    elif argv[:1] == ['memory']:
+        bench_memory(int(argv[1]) * MB if len(argv) > 1 else 100 * MB)
+    elif argv[:1] == ['render']:
+        bench_render_scaling([int(size) for size in argv[1:]] or SIZES)
+    else:
+        raise Exception('Usage: $ python %s suite [--scale N] [--output results.json] [--baseline results.json] | render [sizes...] | escape [src_dir] | classify [src_dir] | templates [sizes...] | memory [size_mb] | scan [count] | pipeline [count] [delay_ms]' % sys.argv[0])
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
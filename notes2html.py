@@ -1,88 +1,1813 @@
+import BaseHTTPServer
+import SocketServer
+import StringIO
 import cgi
+import cProfile
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import email.utils
+import fnmatch
+import gzip
+import hashlib
+import itertools
+import json
+import marshal
+import mimetypes
+import mmap
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
-
+import shutil
+import stat
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+import zipfile
+import zlib
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+USAGE = 'Usage: $ python %s [--incremental] [--jobs N] [--watch] [--index] [--profile] [--profile-top N] [--profile-dump FILE] [--fail-fast | --keep-going] [--error-report FILE] [--assets DIR] [--thumbnails WIDTH] [--fingerprint] [--compress] [--pipeline] [--changed FILE|- | --since REV|-] [--bundle FILE] [--templates DIR] src_dir dst_dir | serve [--port N] [--cache-size BYTES] src_dir | serve [--port N] --bundle FILE'
+MANIFEST = '.notes2html.json'
+MANIFEST_VERSION = 1
+AST_VERSION = 2
+AST_CACHE = '.notes2html.cache'
+IGNORE_FILE = '.notesignore'
+INCLUDE_PATTERN = re.compile(r'([ \t]*)#include (.+)#\s*$')
+SPILL_CHUNK_SIZE = 64 * 1024
+SPILL_MEMORY_SIZE = 1024 * 1024
+EVENT_BATCH_SIZE = 1024
+RENDER_BATCH_SIZE = 1024
+WATCH_INTERVAL = 0.5
+POOL_CHUNK_SIZE = 16
+PIPELINE_READERS = 4
+PIPELINE_WRITERS = 4
+PIPELINE_DEPTH = 32
+PIPELINE_BUFFER_SIZE = 1024 * 1024
+PROFILE_TOP = 10
+SITE_INDEX_STATE = '.notes2html.index.json'
+SITE_INDEX_PAGE = 'index.html'
+SITE_INDEX_TITLE = 'Index'
+SEARCH_INDEX = 'search.json'
+ASSETS_DIR = 'assets'
+THUMBNAILS_DIR = 'assets/thumbs'
+THUMBNAIL_STATE = '.notes2html.thumbs.json'
+COPY_MTIME_TOLERANCE = 0.001
+ASSET_MANIFEST = 'assets/manifest.json'
+FINGERPRINT_LENGTH = 12
+GZIP_LEVEL = 9
+SHELL_ASSETS = {'stylesheet': 'main.css', 'favicon': 'favicon.png', 'script': 'syntaxhighlighter.js'}
+JPEG_SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+TOKEN_PATTERN = re.compile(r'\w+')
+MARKUP_PATTERN = re.compile(r'<[^>]*>|&\w+;')
+SERVE_HOST = '127.0.0.1'
+SERVE_PORT = 8000
+SERVE_CACHE_SIZE = 64 * 1024 * 1024
+BUNDLE_STATE = '.notes2html.bundle.json'
+BUNDLE_DOS_DATE = (1 << 5) | 1
+BUNDLE_LOCAL_HEADER = '<4s5H3L2H'
+BUNDLE_CENTRAL_HEADER = '<4s6H3L5H2L'
+BUNDLE_END = '<4s4H2LH'
+BUNDLE_ZIP64_END = '<4sQ2H2L4Q'
+BUNDLE_ZIP64_LOCATOR = '<4sLQL'
+BUNDLE_ZIP64_LIMIT = 0xffffffff
+BUNDLE_ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+INOTIFY_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+INOTIFY_BUFFER_SIZE = 64 * 1024
+
+FLAGS = ['--incremental', '--watch', '--index', '--profile', '--fail-fast', '--keep-going', '--fingerprint', '--compress', '--pipeline']
+OPTIONS = {'--jobs': int, '--host': str, '--port': int, '--cache-size': int, '--templates': str, '--profile-top': int, '--profile-dump': str, '--error-report': str, '--assets': str, '--thumbnails': int, '--changed': str, '--since': str, '--bundle': str}
 
 
 def run():
     if len(sys.argv) < 3:
-        raise Exception('Usage: $ python %s src_dir dst_dir' % sys.argv[0])
-
-    for a_file in [os.path.join(dp, f) for dp, dn, filenames in os.walk(sys.argv[1]) for f in filenames if os.path.splitext(f)[1] == '.txt']:
-        with open(a_file) as read:
-            out_file = sys.argv[2] + '/' + a_file.replace(sys.argv[1], '').replace('.txt', '.html')
-            if not os.path.exists(out_file[:out_file.rindex('/')]):
-                os.makedirs(out_file[:out_file.rindex('/')])
-            with open(out_file, 'w') as write:
+        raise Exception(USAGE % sys.argv[0])
+    options, args = get_options(sys.argv[1:])
+    if len(args) < 2 and not (args == ['serve'] and options.get('bundle')):
+        raise Exception(USAGE % sys.argv[0])
+    if options.get('fail_fast') and options.get('keep_going'):
+        raise Exception('Options --fail-fast and --keep-going cannot be combined')
+    if (options.get('thumbnails') or options.get('fingerprint')) and not options.get('assets'):
+        raise Exception('Options --thumbnails and --fingerprint need --assets')
+    if options.get('pipeline') and options.get('jobs', 1) > 1:
+        raise Exception('Options --pipeline and --jobs cannot be combined')
+    if options.get('changed') and options.get('since'):
+        raise Exception('Options --changed and --since cannot be combined')
+    if options.get('changed') or options.get('since'):
+        options['incremental'] = True
+    if options.get('thumbnails') and Image is None:
+        raise Exception('Option --thumbnails needs PIL (Pillow) to be installed')
+    if options.get('templates'):
+        TEMPLATES.update(load_templates(options['templates']))
+    if options.get('profile_dump'):
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(dispatch, args, options)
+        finally:
+            profiler.dump_stats(options['profile_dump'])
+    return dispatch(args, options)
+
+
+def dispatch(args, options):
+    if args[0] == 'serve':
+        serve(args[1] if len(args) > 1 else None, options)
+    elif options.get('watch'):
+        watch(args[0], args[1], options)
+    elif options.get('changed'):
+        return 1 if build(args[0], args[1], options, read_changed_notes(args[0], options['changed'])) else 0
+    elif options.get('since'):
+        a_files, renames = read_git_changes(args[0], options['since'])
+        return 1 if build(args[0], args[1], options, a_files, renames) else 0
+    else:
+        return 1 if build(args[0], args[1], options) else 0
+
+
+def read_changed_notes(src_dir, source):
+    if source == '-':
+        paths = sys.stdin.read().splitlines()
+    else:
+        with open(source) as read:
+            paths = read.read().splitlines()
+    return sorted(set(a_file for a_file in (get_source_file(src_dir, path) for path in paths) if a_file is not None))
+
+
+def read_git_changes(src_dir, rev):
+    if rev == '-':
+        lines = sys.stdin.read().splitlines()
+        base_dir = os.curdir
+    else:
+        try:
+            process = subprocess.Popen(['git', '-c', 'core.quotepath=off', 'diff', '--name-status', '-M', '--relative', rev, '--', '.'], cwd=src_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            output, errors = process.communicate()
+        except OSError as e:
+            raise Exception('Unable to read git changes since [%s] in [%s] [%s]' % (rev, src_dir, e))
+        if process.returncode != 0:
+            raise Exception('Unable to read git changes since [%s] in [%s] [%s]' % (rev, src_dir, errors.strip()))
+        lines = output.splitlines()
+        base_dir = src_dir
+    a_files = set()
+    renames = []
+    for line in lines:
+        fields = line.split('\t')
+        if len(fields) < 2:
+            continue
+        status = fields[0][:1]
+        paths = [get_source_file(src_dir, os.path.join(base_dir, path)) for path in fields[1:]]
+        if status == 'R' and None not in paths and all(is_note_file(path) for path in paths):
+            renames.append((paths[0], paths[1]))
+        elif status == 'C':
+            paths = paths[1:]
+        a_files.update(a_file for a_file in paths if a_file is not None)
+    return sorted(a_files), renames
+
+
+def get_source_file(src_dir, path):
+    relative = os.path.relpath(os.path.abspath(path.strip()), os.path.abspath(src_dir))
+    if path.strip() and not relative.startswith(os.pardir):
+        return os.path.join(src_dir, relative)
+    return None
+
+
+def get_options(argv):
+    options = {}
+    args = []
+    iter_argv = iter(argv)
+    for arg in iter_argv:
+        if arg in FLAGS:
+            options[arg[2:].replace('-', '_')] = True
+        elif arg in OPTIONS:
+            try:
+                options[arg[2:].replace('-', '_')] = OPTIONS[arg](next(iter_argv))
+            except (StopIteration, ValueError):
+                raise Exception('Invalid value for option %s' % arg)
+        elif arg.startswith('--'):
+            raise Exception('Unknown option %s. %s' % (arg, USAGE % sys.argv[0]))
+        else:
+            args.append(arg)
+    return options, args
+
+
+def build(src_dir, dst_dir, options, a_files=None, renames=(), graph=None):
+    started = time.time()
+    if options.get('assets'):
+        ASSETS['dir'] = options['assets']
+        ASSETS['images'] = process_assets(options['assets'], dst_dir, options)
+        ASSETS['shell'] = fingerprint_assets(options['assets'], dst_dir) if options.get('fingerprint') else {}
+        ASSETS['thumbnails'] = options.get('thumbnails')
+    incremental = options.get('incremental', False)
+    manifest = load_manifest(dst_dir) if incremental else {}
+    site_index = load_state(dst_dir, SITE_INDEX_STATE) if options.get('index') else None
+    if graph is None:
+        graph = dict((key, entry['includes']) for key, entry in manifest.items() if entry.get('includes'))
+    scanned_stats = {}
+    if a_files is None:
+        scanned_stats = dict(scan_notes(src_dir, incremental))
+        a_files = sorted(scanned_stats)
+        notes = {}
+        found = set(os.path.relpath(a_file, src_dir) for a_file in a_files)
+        removed = set(manifest) - found
+        if site_index is not None:
+            site_index = dict((key, outline) for key, outline in site_index.items() if key in found)
+    else:
+        rules = load_ignore_rules(src_dir)
+        renames = [(old_file, new_file) for old_file, new_file in renames if not is_ignored_path(os.path.relpath(new_file, src_dir), rules)]
+        move_outputs(renames, src_dir, dst_dir, manifest, site_index, graph)
+        notes = dict(manifest)
+        found = None
+        a_files = [a_file for a_file in add_dependents(a_files, graph, src_dir) if is_note_file(a_file)]
+        removed = set(os.path.relpath(a_file, src_dir) for a_file in a_files if not os.path.exists(a_file))
+        a_files = [a_file for a_file in a_files if os.path.exists(a_file) and not is_ignored_path(os.path.relpath(a_file, src_dir), rules)]
+
+    stats = {}
+    include_stats = {}
+    jobs = []
+    out_dirs = set()
+    diagnostics = []
+    ast_cache = os.path.join(dst_dir, AST_CACHE) if incremental else None
+    if ast_cache is not None and not os.path.isdir(ast_cache):
+        os.makedirs(ast_cache)
+    for a_file in a_files:
+        out_file = get_out_file(a_file, src_dir, dst_dir)
+        entry = None
+        stat_unchanged = False
+        stale = False
+        if incremental:
+            key = os.path.relpath(a_file, src_dir)
+            try:
+                stat = scanned_stats.get(a_file) or os.stat(a_file)
+            except OSError as e:
+                report_diagnostic(diagnostics, get_diagnostic(a_file, e))
+                continue
+            entry = manifest.get(key)
+            if entry is not None and os.path.exists(out_file) and (site_index is None or key in site_index) and not (options.get('compress') and is_compression_missing(out_file)):
+                stat_unchanged = entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size and not are_includes_changed(entry.get('includes'), src_dir, include_stats)
+                stale = entry.get('stale', False) or are_images_changed(entry.get('images'))
+                if stat_unchanged and not stale:
+                    notes[key] = entry
+                    continue
+            else:
+                entry = None
+            stats[a_file] = stat
+        out_dir = out_file[:out_file.rindex('/')]
+        if out_dir not in out_dirs:
+            out_dirs.add(out_dir)
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+        jobs.append({
+            'file': a_file,
+            'out_file': out_file,
+            'known_hash': entry['hash'] if entry is not None else None,
+            'stat_unchanged': stat_unchanged,
+            'stale': stale,
+            'ast_cache': ast_cache,
+            'outline': site_index is not None,
+            'profile': options.get('profile', False),
+            'compress': options.get('compress', False),
+            'src_dir': src_dir,
+            'pipeline': options.get('pipeline', False),
+            'source': None,
+        })
+
+    if diagnostics and options.get('fail_fast'):
+        jobs = []
+    scanned = time.time()
+    profiles = []
+    if options.get('pipeline'):
+        results = map_jobs_pipelined(jobs)
+    else:
+        results = map_jobs(convert_note, jobs, options.get('jobs', 1))
+    for note in results:
+        if note['profile'] is not None:
+            profiles.append((note['file'], note['profile']))
+        if note['error'] is not None:
+            report_diagnostic(diagnostics, note['error'])
+            if options.get('fail_fast'):
+                results.close()
+                break
+            continue
+        key = os.path.relpath(note['file'], src_dir)
+        if note['outline'] is not None:
+            site_index[key] = note['outline']
+        if note['includes']:
+            graph[key] = note['includes']
+        elif note['includes'] is not None:
+            graph.pop(key, None)
+        if incremental:
+            stat = stats[note['file']]
+            output_hash = note['output_hash'] or manifest[key]['output_hash']
+            includes = graph.get(key)
+            images = note['images'] if note['images'] is not None else manifest[key].get('images')
+            notes[key] = {
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'hash': note['hash'],
+                'output_hash': output_hash,
+            }
+            if includes:
+                notes[key]['includes'] = includes
+            if images:
+                notes[key]['images'] = images
+
+    rendered = time.time()
+    for key in removed:
+        out_file = get_out_file(os.path.join(src_dir, key), src_dir, dst_dir)
+        for path in [out_file] + [out_file + suffix for suffix in get_compressed_suffixes()]:
+            if os.path.exists(path):
+                os.remove(path)
+        notes.pop(key, None)
+        graph.pop(key, None)
+        if site_index is not None:
+            site_index.pop(key, None)
+    if incremental:
+        save_manifest(dst_dir, notes)
+        if found is not None:
+            clean_ast_cache(os.path.join(dst_dir, AST_CACHE), set(entry['hash'] for entry in notes.values()))
+    if site_index is not None:
+        write_site_index(src_dir, dst_dir, site_index, options.get('compress', False))
+        save_state(dst_dir, SITE_INDEX_STATE, site_index)
+    if options.get('bundle'):
+        write_bundle(dst_dir, options['bundle'])
+    if options.get('profile'):
+        print_profile([('scan', scanned - started), ('render', rendered - scanned), ('finish', time.time() - rendered)], profiles, options.get('profile_top', PROFILE_TOP))
+    if options.get('error_report'):
+        write_error_report(options['error_report'], diagnostics)
+    return diagnostics
+
+
+def report_diagnostic(diagnostics, diagnostic):
+    print 'Error when parsing [%s] [%s]' % (diagnostic['file'], diagnostic['message'])
+    diagnostics.append(diagnostic)
+
+
+def add_dependents(a_files, graph, src_dir):
+    keys = set(os.path.relpath(a_file, src_dir) for a_file in a_files)
+    dependents = set(key for key, includes in graph.items() if keys.intersection(includes))
+    return sorted(set(a_files) | set(os.path.join(src_dir, key) for key in dependents - keys))
+
+
+def move_outputs(renames, src_dir, dst_dir, manifest, site_index, graph):
+    for old_file, new_file in renames:
+        old_key = os.path.relpath(old_file, src_dir)
+        new_key = os.path.relpath(new_file, src_dir)
+        old_out_file = get_out_file(old_file, src_dir, dst_dir)
+        new_out_file = get_out_file(new_file, src_dir, dst_dir)
+        for suffix in [''] + get_compressed_suffixes():
+            if os.path.exists(old_out_file + suffix):
+                make_out_dir(new_out_file)
+                os.rename(old_out_file + suffix, new_out_file + suffix)
+        if old_key in manifest:
+            manifest[new_key] = manifest.pop(old_key)
+        if old_key in graph:
+            graph[new_key] = graph.pop(old_key)
+        if site_index is not None and old_key in site_index:
+            site_index[new_key] = site_index.pop(old_key)
+
+
+def are_includes_changed(includes, src_dir, include_stats):
+    for key, (mtime, size) in (includes or {}).items():
+        if key not in include_stats:
+            try:
+                stat = os.stat(os.path.join(src_dir, key))
+                include_stats[key] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                include_stats[key] = None
+        if include_stats[key] != (mtime, size):
+            return True
+    return False
+
+
+def are_images_changed(images):
+    for name, state in (images or {}).items():
+        if get_image_state(name) != state:
+            return True
+    return False
+
+
+def write_error_report(path, diagnostics):
+    with open(path + '.tmp', 'w') as write:
+        json.dump({'errors': diagnostics}, write, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def get_diagnostic(a_file, e, line_map=None):
+    if isinstance(e, ParseError):
+        line, column = map_line(line_map, e.line, e.column) if line_map and e.line is not None else (e.line, e.column)
+        return {'file': a_file, 'line': line, 'column': column, 'rule': e.rule, 'message': str(e)}
+    return {'file': a_file, 'line': None, 'column': None, 'rule': 'io' if isinstance(e, EnvironmentError) else 'internal', 'message': str(e)}
+
+
+def map_line(line_map, line, column):
+    mapped = line, column
+    for start, number, step, directive_column in line_map:
+        if start > line:
+            break
+        mapped = number + (line - start) * step, directive_column or column
+    return mapped
+
+
+def process_assets(assets_dir, dst_dir, options):
+    max_width = options.get('thumbnails')
+    thumbnails = load_state(dst_dir, THUMBNAIL_STATE) if max_width else {}
+    images = {}
+    jobs = []
+    for a_file in find_files(assets_dir, IMG_EXTENSIONS):
+        name = os.path.relpath(a_file, assets_dir).replace(os.sep, '/')
+        copy_if_changed(a_file, os.path.join(dst_dir, ASSETS_DIR, name))
+        size = read_image_size(a_file)
+        images[name] = {'src': IMG_LINK % name, 'width': size and size[0], 'height': size and size[1]}
+        if not max_width or size is None or size[0] <= max_width:
+            thumbnails.pop(name, None)
+            continue
+        out_file = os.path.join(dst_dir, THUMBNAILS_DIR, name)
+        stat = os.stat(a_file)
+        state = thumbnails.get(name)
+        if state is not None and state['max_width'] == max_width and os.path.exists(out_file):
+            if (state['mtime'], state['size']) != (stat.st_mtime, stat.st_size):
+                with open(a_file, 'rb') as read:
+                    digest = hash_lines(iter(lambda: read.read(SPILL_CHUNK_SIZE), ''))
+                if digest != state['hash']:
+                    state = None
+                else:
+                    state.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+        else:
+            state = None
+        if state is None:
+            jobs.append({'name': name, 'file': a_file, 'out_file': out_file, 'max_width': max_width})
+        else:
+            images[name] = {'src': THUMBNAIL_LINK % name, 'width': state['width'], 'height': state['height']}
+
+    for thumbnail in map_jobs(make_thumbnail, jobs, options.get('jobs', 1)):
+        name = thumbnail['name']
+        if thumbnail['error'] is not None:
+            print 'Error when making thumbnail [%s] [%s]' % (name, thumbnail['error'])
+            thumbnails.pop(name, None)
+            continue
+        thumbnails[name] = thumbnail['state']
+        images[name] = {'src': THUMBNAIL_LINK % name, 'width': thumbnail['state']['width'], 'height': thumbnail['state']['height']}
+    if max_width:
+        save_state(dst_dir, THUMBNAIL_STATE, dict((name, state) for name, state in thumbnails.items() if name in images))
+    return images
+
+
+def fingerprint_assets(assets_dir, dst_dir):
+    fingerprints = {}
+    for name in sorted(SHELL_ASSETS.values()):
+        a_file = os.path.join(assets_dir, name)
+        if not os.path.exists(a_file):
+            continue
+        with open(a_file, 'rb') as read:
+            digest = hash_lines(iter(lambda: read.read(SPILL_CHUNK_SIZE), ''))
+        root, extension = os.path.splitext(name)
+        fingerprints[name] = '%s.%s%s' % (root, digest[:FINGERPRINT_LENGTH], extension)
+        out_file = os.path.join(dst_dir, ASSETS_DIR, fingerprints[name])
+        if not os.path.exists(out_file):
+            make_out_dir(out_file)
+            shutil.copyfile(a_file, out_file + '.tmp')
+            os.rename(out_file + '.tmp', out_file)
+    out_file = os.path.join(dst_dir, ASSET_MANIFEST)
+    make_out_dir(out_file)
+    write_if_changed(out_file, iter([json.dumps(fingerprints, indent=2, sort_keys=True)]), hashlib.sha1())
+    return fingerprints
+
+
+def make_thumbnail(job):
+    thumbnail = {'name': job['name'], 'state': None, 'error': None}
+    try:
+        stat = os.stat(job['file'])
+        with open(job['file'], 'rb') as read:
+            digest = hash_lines(iter(lambda: read.read(SPILL_CHUNK_SIZE), ''))
+        image = Image.open(job['file'])
+        image_format = image.format
+        image.thumbnail((job['max_width'], image.size[1]), Image.ANTIALIAS)
+        make_out_dir(job['out_file'])
+        tmp_file = job['out_file'] + '.tmp'
+        image.save(tmp_file, image_format)
+        os.rename(tmp_file, job['out_file'])
+    except Exception as e:
+        thumbnail['error'] = str(e)
+        return thumbnail
+    thumbnail['state'] = {
+        'mtime': stat.st_mtime,
+        'size': stat.st_size,
+        'hash': digest,
+        'max_width': job['max_width'],
+        'width': image.size[0],
+        'height': image.size[1],
+    }
+    return thumbnail
+
+
+def copy_if_changed(a_file, out_file):
+    stat = os.stat(a_file)
+    try:
+        out_stat = os.stat(out_file)
+    except OSError:
+        out_stat = None
+    if out_stat is not None and out_stat.st_size == stat.st_size and abs(out_stat.st_mtime - stat.st_mtime) < COPY_MTIME_TOLERANCE:
+        return False
+    make_out_dir(out_file)
+    shutil.copy2(a_file, out_file + '.tmp')
+    os.rename(out_file + '.tmp', out_file)
+    return True
+
+
+def read_image_size(a_file):
+    with open(a_file, 'rb') as read:
+        head = read.read(24)
+        try:
+            if head.startswith('\x89PNG\r\n\x1a\n') and head[12:16] == 'IHDR':
+                return struct.unpack('>II', head[16:24])
+            if head[:6] in ('GIF87a', 'GIF89a'):
+                return struct.unpack('<HH', head[6:10])
+            if head.startswith('\xff\xd8'):
+                read.seek(2)
+                return read_jpeg_size(read)
+        except struct.error:
+            pass
+    return None
+
+
+def read_jpeg_size(read):
+    while True:
+        marker = read.read(2)
+        if len(marker) != 2 or marker[0] != '\xff':
+            return None
+        if marker[1] == '\xff':
+            read.seek(-1, 1)
+            continue
+        length = struct.unpack('>H', read.read(2))[0]
+        if ord(marker[1]) in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>xHH', read.read(5))
+            return width, height
+        read.seek(length - 2, 1)
+
+
+def watch(src_dir, dst_dir, options):
+    graph = {}
+    changes = iter_changes(src_dir, graph)
+    build(src_dir, dst_dir, options, graph=graph)
+    print 'Watching [%s] for changes' % src_dir
+    for a_files in changes:
+        included = get_included_files(src_dir, graph)
+        a_files = [a_file for a_file in a_files if is_note_file(a_file) or a_file in included]
+        if not a_files:
+            continue
+        start = time.time()
+        build(src_dir, dst_dir, options, a_files, graph=graph)
+        print 'Rebuilt %d note(s) in %.1f ms' % (len(a_files), (time.time() - start) * 1000)
+
+
+def iter_changes(src_dir, graph):
+    try:
+        return iter_inotify_changes(src_dir)
+    except (OSError, AttributeError):
+        return iter_polled_changes(src_dir, WATCH_INTERVAL, graph)
+
+
+def get_included_files(src_dir, graph):
+    return set(os.path.join(src_dir, key) for includes in graph.values() for key in includes)
+
+
+def is_note_file(a_file):
+    return os.path.splitext(a_file)[1] == '.txt'
+
+
+def iter_inotify_changes(src_dir):
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    fd = libc.inotify_init()
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_init failed')
+    watches = {}
+    for dp, dn, filenames in os.walk(src_dir):
+        add_inotify_watch(libc, fd, watches, dp)
+    return read_inotify_changes(libc, fd, watches)
+
+
+def add_inotify_watch(libc, fd, watches, directory):
+    wd = libc.inotify_add_watch(fd, directory, INOTIFY_MASK)
+    if wd < 0:
+        raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for [%s]' % directory)
+    watches[wd] = directory
+
+
+def read_inotify_changes(libc, fd, watches):
+    try:
+        while True:
+            events = os.read(fd, INOTIFY_BUFFER_SIZE)
+            a_files = set()
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, length = struct.unpack_from('iIII', events, offset)
+                name = events[offset + 16:offset + 16 + length].rstrip('\0')
+                offset += 16 + length
+                if wd not in watches:
+                    continue
+                path = os.path.join(watches[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        for dp, dn, filenames in os.walk(path):
+                            add_inotify_watch(libc, fd, watches, dp)
+                        a_files.update(find_notes(path))
+                elif not mask & IN_CREATE:
+                    a_files.add(path)
+            if a_files:
+                yield sorted(a_files)
+    finally:
+        os.close(fd)
+
+
+def iter_polled_changes(src_dir, interval, graph=None):
+    return poll_changes(src_dir, snapshot_notes(src_dir, graph), interval, graph)
+
+
+def poll_changes(src_dir, snapshot, interval, graph):
+    while True:
+        time.sleep(interval)
+        current = snapshot_notes(src_dir, graph)
+        a_files = sorted(a_file for a_file in set(snapshot) | set(current) if snapshot.get(a_file) != current.get(a_file))
+        snapshot = current
+        if a_files:
+            yield a_files
+
+
+def snapshot_notes(src_dir, graph):
+    snapshot = {}
+    for a_file in find_notes(src_dir) + sorted(get_included_files(src_dir, graph or {})):
+        try:
+            stat = os.stat(a_file)
+        except OSError:
+            continue
+        snapshot[a_file] = (stat.st_mtime, stat.st_size)
+    return snapshot
+
+
+def serve(src_dir, options):
+    if options.get('bundle'):
+        src_dir = options['bundle']
+        server = make_bundle_server(src_dir, options.get('host', SERVE_HOST), options.get('port', SERVE_PORT))
+    else:
+        server = make_server(src_dir, options.get('host', SERVE_HOST), options.get('port', SERVE_PORT), options.get('cache_size', SERVE_CACHE_SIZE))
+    print 'Serving [%s] on http://%s:%d/' % (src_dir, server.server_address[0], server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def make_server(src_dir, host, port, cache_size):
+    server = PreviewServer((host, port), PreviewHandler)
+    server.src_dir = os.path.abspath(src_dir)
+    server.cache = LRUCache(cache_size)
+    return server
+
+
+def make_bundle_server(bundle_file, host, port):
+    server = PreviewServer((host, port), BundleHandler)
+    server.bundle_file = bundle_file
+    server.bundle = open_bundle(bundle_file)
+    server.bundle_lock = threading.Lock()
+    return server
+
+
+class PreviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class PreviewHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        if path.endswith('/'):
+            path += 'index.html'
+        a_file = os.path.normpath(os.path.join(self.server.src_dir, path.lstrip('/')))
+        if not path.endswith('.html') or not a_file.startswith(self.server.src_dir + os.sep):
+            return self.send_error(404)
+        a_file = a_file[:-len('.html')] + '.txt'
+        try:
+            stat = os.stat(a_file)
+        except OSError:
+            return self.send_error(404)
+
+        key = (a_file, stat.st_mtime, stat.st_size)
+        page = self.server.cache.get(key)
+        if page is None or are_includes_changed(page['includes'], self.server.src_dir, {}):
+            includes = {}
+            try:
+                with open(a_file) as read:
+                    html = parse(list(expand_includes(read, a_file, self.server.src_dir, includes)))
+            except Exception as e:
+                return self.send_error(500, 'Error when parsing [%s] [%s]' % (a_file, str(e)))
+            mtime = max([stat.st_mtime] + [include[0] for include in includes.values()])
+            page = {'html': html, 'etag': '"%s"' % hashlib.sha1(html).hexdigest(), 'includes': includes, 'mtime': mtime}
+            self.server.cache.put(key, page, len(html))
+
+        if self.is_not_modified(page['etag'], page['mtime']):
+            self.send_response(304)
+            self.send_header('ETag', page['etag'])
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page['html'])))
+        self.send_header('ETag', page['etag'])
+        self.send_header('Last-Modified', email.utils.formatdate(page['mtime'], usegmt=True))
+        self.end_headers()
+        self.wfile.write(page['html'])
+
+    def is_not_modified(self, etag, mtime):
+        if self.headers.get('If-None-Match') is not None:
+            return etag in [tag.strip() for tag in self.headers['If-None-Match'].split(',')]
+        since = email.utils.parsedate_tz(self.headers.get('If-Modified-Since', ''))
+        return since is not None and int(mtime) <= email.utils.mktime_tz(since)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class BundleHandler(PreviewHandler):
+    def do_GET(self):
+        bundle = self.get_bundle()
+        path = urllib.unquote(urlparse.urlparse(self.path).path)
+        if path.endswith('/'):
+            path += 'index.html'
+        key = path.lstrip('/')
+        entry = bundle['entries'].get(key)
+        if entry is None:
+            return self.send_error(404)
+        accepted = [token.split(';')[0].strip() for token in self.headers.get('Accept-Encoding', '').split(',')]
+        encodings = [(encoding, key + suffix) for encoding, suffix in BUNDLE_ENCODINGS if key + suffix in bundle['entries']]
+        encoding = None
+        for candidate, encoded_key in encodings:
+            if candidate in accepted:
+                encoding, entry = candidate, bundle['entries'][encoded_key]
+                break
+        start, size, crc = entry[:3]
+        etag = '"%08x-%x"' % (crc, size)
+
+        if self.is_not_modified(etag, bundle['mtime']):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', get_content_type(path))
+        self.send_header('Content-Length', str(size))
+        if encodings:
+            self.send_header('Vary', 'Accept-Encoding')
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(bundle['mtime'], usegmt=True))
+        self.end_headers()
+        self.wfile.write(bundle['mapped'][start:start + size])
+
+    def get_bundle(self):
+        stat = os.stat(self.server.bundle_file)
+        with self.server.bundle_lock:
+            if self.server.bundle['key'] != (stat.st_ino, stat.st_mtime, stat.st_size):
+                self.server.bundle = open_bundle(self.server.bundle_file)
+            return self.server.bundle
+
+
+def get_content_type(path):
+    if path.endswith('.html'):
+        return 'text/html; charset=utf-8'
+    return mimetypes.guess_type(path)[0] or 'application/octet-stream'
+
+
+def write_bundle(dst_dir, bundle_file):
+    dst_path = os.path.abspath(dst_dir)
+    bundle_path = os.path.abspath(bundle_file)
+    pages = []
+    for dir_path, dir_names, file_names in os.walk(dst_path):
+        dir_names[:] = [name for name in dir_names if not name.startswith('.')]
+        prefix = dir_path[len(dst_path) + 1:].replace(os.sep, '/')
+        for name in file_names:
+            path = dir_path + os.sep + name
+            if not name.startswith('.') and not name.endswith('.tmp') and path != bundle_path:
+                stat = os.stat(path)
+                pages.append((prefix + '/' + name if prefix else name, path, [stat.st_mtime, stat.st_size]))
+    pages.sort()
+
+    try:
+        previous = open_bundle(bundle_file)
+    except (EnvironmentError, zipfile.BadZipfile):
+        previous = {'mapped': None, 'entries': {}}
+    state = load_state(dst_dir, BUNDLE_STATE)
+    reused = {}
+    for name, path, stat in pages:
+        entry = previous['entries'].get(name)
+        if entry is not None and state.get(name) == stat + [entry[2]]:
+            reused[name] = entry
+    if previous['mapped'] is not None and len(reused) == len(pages) == len(previous['entries']):
+        return
+
+    state = {}
+    directory = []
+    with open(bundle_file + '.tmp', 'wb') as write:
+        offset = 0
+        run = None
+        for name, path, stat in pages:
+            if name in reused:
+                start, size, crc, header_offset = reused[name]
+                if run is None or run[1] != header_offset:
+                    copy_range(write, previous['mapped'], run)
+                    run = [header_offset, header_offset]
+                run[1] = start + size
+            else:
+                copy_range(write, previous['mapped'], run)
+                run = None
+                crc, size = pack_file(write, name, path)
+            directory.append((name, crc, size, offset))
+            offset = write.tell() + (run[1] - run[0] if run is not None else 0)
+            state[name] = stat + [crc]
+        copy_range(write, previous['mapped'], run)
+        write_central_directory(write, directory)
+    os.rename(bundle_file + '.tmp', bundle_file)
+    save_state(dst_dir, BUNDLE_STATE, state)
+
+
+def copy_range(write, mapped, run):
+    if run is None:
+        return
+    for block in range(run[0], run[1], SPILL_CHUNK_SIZE):
+        write.write(mapped[block:min(block + SPILL_CHUNK_SIZE, run[1])])
+
+
+def pack_local_header(name, crc, size):
+    return struct.pack(BUNDLE_LOCAL_HEADER, 'PK\x03\x04', 20, 0, 0, 0, BUNDLE_DOS_DATE, crc, size, size, len(name), 0) + name
+
+
+def pack_file(write, name, path):
+    header_offset = write.tell()
+    write.write(pack_local_header(name, 0, 0))
+    crc = 0
+    size = 0
+    with open(path, 'rb') as read:
+        for block in iter(lambda: read.read(SPILL_CHUNK_SIZE), ''):
+            crc = zlib.crc32(block, crc)
+            size += len(block)
+            write.write(block)
+    if size >= BUNDLE_ZIP64_LIMIT:
+        raise Exception('Page [%s] is too large for a bundle' % path)
+    end = write.tell()
+    write.seek(header_offset)
+    write.write(pack_local_header(name, crc & 0xffffffff, size))
+    write.seek(end)
+    return crc & 0xffffffff, size
+
+
+def write_central_directory(write, directory):
+    start = write.tell()
+    for name, crc, size, offset in directory:
+        extra = struct.pack('<2HQ', 1, 8, offset) if offset >= BUNDLE_ZIP64_LIMIT else ''
+        write.write(struct.pack(BUNDLE_CENTRAL_HEADER, 'PK\x01\x02', 0x0314, 45 if extra else 20, 0, 0, 0, BUNDLE_DOS_DATE, crc, size, size, len(name), len(extra), 0, 0, 0, 0644 << 16, min(offset, BUNDLE_ZIP64_LIMIT)))
+        write.write(name + extra)
+    end = write.tell()
+    count = len(directory)
+    if count >= 0xffff or end >= BUNDLE_ZIP64_LIMIT:
+        write.write(struct.pack(BUNDLE_ZIP64_END, 'PK\x06\x06', 44, 45, 45, 0, 0, count, count, end - start, start))
+        write.write(struct.pack(BUNDLE_ZIP64_LOCATOR, 'PK\x06\x07', 0, end, 1))
+    write.write(struct.pack(BUNDLE_END, 'PK\x05\x06', 0, 0, min(count, 0xffff), min(count, 0xffff), min(end - start, BUNDLE_ZIP64_LIMIT), min(start, BUNDLE_ZIP64_LIMIT), 0))
+
+
+def open_bundle(bundle_file):
+    with open(bundle_file, 'rb') as read:
+        stat = os.fstat(read.fileno())
+        infos = zipfile.ZipFile(read).infolist()
+        mapped = mmap.mmap(read.fileno(), 0, access=mmap.ACCESS_READ)
+    entries = {}
+    header_size = struct.calcsize(BUNDLE_LOCAL_HEADER)
+    for info in infos:
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise Exception('Unsupported compressed entry [%s] in bundle [%s]' % (info.filename, bundle_file))
+        header = struct.unpack(BUNDLE_LOCAL_HEADER, mapped[info.header_offset:info.header_offset + header_size])
+        start = info.header_offset + header_size + header[9] + header[10]
+        entries[info.filename] = (start, info.file_size, info.CRC & 0xffffffff, info.header_offset)
+    return {'key': (stat.st_ino, stat.st_mtime, stat.st_size), 'mtime': stat.st_mtime, 'mapped': mapped, 'entries': entries}
+
+
+class LRUCache(object):
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def put(self, key, value, size):
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)[1]
+            if size > self.max_size:
+                return
+            for stale in [cached for cached in self.entries if cached[0] == key[0]]:
+                self.size -= self.entries.pop(stale)[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self.entries.popitem(last=False)[1][1]
+
+
+def convert_many(notes, processes=1):
+    return map_jobs(convert_text, notes, processes)
+
+
+def convert_text(item):
+    name, text = item
+    try:
+        outline = {'title': None, 'sections': []}
+        html = ''.join(render_note(build_note(list(StringIO.StringIO(text))), outline))
+    except Exception as e:
+        return name, None, [], [str(e)]
+    return name, html, outline['sections'], []
+
+
+def map_jobs(function, jobs, processes):
+    if processes <= 1 or hasattr(jobs, '__len__') and len(jobs) <= 1:
+        return (function(job) for job in jobs)
+    return map_jobs_in_pool(function, jobs, processes)
+
+
+def map_jobs_in_pool(function, jobs, processes):
+    if hasattr(jobs, '__len__'):
+        chunksize = max(1, len(jobs) // (processes * 4))
+        batches = [jobs]
+    else:
+        chunksize = POOL_CHUNK_SIZE
+        batches = iter_batches(jobs, processes * POOL_CHUNK_SIZE * 2)
+    pool = multiprocessing.Pool(processes)
+    try:
+        for batch in batches:
+            for result in pool.imap(function, batch, chunksize=chunksize):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def iter_batches(items, size):
+    iter_items = iter(items)
+    batch = list(itertools.islice(iter_items, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iter_items, size))
+
+
+def map_jobs_pipelined(jobs):
+    readers = multiprocessing.pool.ThreadPool(PIPELINE_READERS)
+    writers = multiprocessing.pool.ThreadPool(PIPELINE_WRITERS)
+    try:
+        sources = imap_bounded(readers, prefetch_source, jobs, PIPELINE_DEPTH)
+        for note in imap_bounded(writers, write_rendered, itertools.imap(convert_prefetched, sources), PIPELINE_DEPTH):
+            yield note
+    finally:
+        readers.terminate()
+        writers.terminate()
+        readers.join()
+        writers.join()
+
+
+def imap_bounded(pool, function, items, depth):
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def prefetch_source(job):
+    if job['known_hash'] is not None and job['stat_unchanged']:
+        return job
+    try:
+        with open(job['file'], 'rb') as read:
+            if os.fstat(read.fileno()).st_size > PIPELINE_BUFFER_SIZE:
+                return job
+            return dict(job, source=read.read())
+    except IOError:
+        return job
+
+
+def convert_prefetched(job):
+    return job, convert_note(job)
+
+
+def write_rendered(job_note):
+    job, note = job_note
+    if 'pending' not in note:
+        return note
+    output_digest, outline, profile = note.pop('pending')
+    try:
+        note['changed'] = write_if_changed(job['out_file'], note.pop('rendered'), output_digest)
+    except EnvironmentError as e:
+        note['error'] = get_diagnostic(note['file'], e)
+        return note
+    return finish_note(note, job, output_digest, outline, profile)
+
+
+def open_source(job):
+    if job['source'] is not None:
+        return contextlib.closing(StringIO.StringIO(job['source']))
+    return open(job['file'])
+
+
+def convert_note(job):
+    a_file, out_file = job['file'], job['out_file']
+    note = {'file': a_file, 'hash': None, 'output_hash': None, 'changed': False, 'outline': None, 'includes': None, 'images': None, 'error': None, 'profile': None}
+    profile = new_profile() if job['profile'] else None
+    known_hash = job['known_hash']
+    if known_hash is not None and not job['stat_unchanged']:
+        note['includes'] = {}
+        line_map = []
+        try:
+            with open_source(job) as read:
+                note['hash'] = hash_lines(expand_includes(read, a_file, job['src_dir'], note['includes'], line_map=line_map))
+        except Exception as e:
+            note['error'] = get_diagnostic(a_file, e, line_map)
+            return note
+        if note['hash'] != known_hash:
+            known_hash = None
+        elif not job['stale'] and not (job['compress'] and is_compression_missing(out_file)):
+            return note
+
+    if known_hash is not None and job['ast_cache'] is not None:
+        outline = {'title': None, 'sections': []} if job['outline'] else None
+        output_digest = hashlib.sha1()
+        try:
+            with open(os.path.join(job['ast_cache'], known_hash + '.ast'), 'rb') as read:
+                note['images'] = {}
+                chunks = parse_cached(read, outline, profile, note['images'])
+                if profile is not None:
+                    chunks = profiled_chunks(chunks, profile)
+                note['changed'] = write_output(job, note, chunks, output_digest)
+        except (IOError, EOFError, ValueError):
+            pass
+        except (ParseError, KeyError) as e:
+            note['error'] = get_diagnostic(a_file, e)
+            return note
+        else:
+            note['hash'] = known_hash
+            if profile is not None:
+                profile['cached'] = True
+            return finish_note(note, job, output_digest, outline, profile)
+
+    digest = hashlib.sha1()
+    output_digest = hashlib.sha1()
+    outline = {'title': None, 'sections': []} if job['outline'] else None
+    ast_file = None
+    ast_tmp = None
+    line_map = []
+    try:
+        if job['ast_cache'] is not None:
+            fd, ast_tmp = tempfile.mkstemp(suffix='.tmp', dir=job['ast_cache'])
+            ast_file = os.fdopen(fd, 'wb')
+        with open_source(job) as read:
+            note['includes'] = {}
+            lines = hashed_lines(expand_includes(read, a_file, job['src_dir'], note['includes'], line_map=line_map), digest)
+            if profile is not None:
+                lines = profiled_lines(lines, profile)
+            note['images'] = {}
+            chunks = parse_stream(lines, outline, ast_file, profile, note['images'])
+            if profile is not None:
+                chunks = profiled_chunks(chunks, profile)
+            note['changed'] = write_output(job, note, chunks, output_digest)
+    except Exception as e:
+        if ast_file is not None:
+            ast_file.close()
+        if ast_tmp is not None:
+            os.remove(ast_tmp)
+        note['error'] = get_diagnostic(a_file, e, line_map)
+        return note
+    note['hash'] = digest.hexdigest()
+    if ast_file is not None:
+        ast_file.close()
+        os.rename(ast_tmp, os.path.join(job['ast_cache'], note['hash'] + '.ast'))
+    return finish_note(note, job, output_digest, outline, profile)
+
+
+def write_output(job, note, chunks, digest):
+    if not job['pipeline']:
+        return write_if_changed(job['out_file'], chunks, digest)
+    chunks = iter(chunks)
+    rendered = []
+    size = 0
+    for chunk in chunks:
+        rendered.append(chunk)
+        size += len(chunk)
+        if size > PIPELINE_BUFFER_SIZE:
+            return write_if_changed(job['out_file'], itertools.chain(rendered, chunks), digest)
+    note['rendered'] = [''.join(rendered)]
+    return False
+
+
+def finish_note(note, job, output_digest, outline, profile):
+    if 'rendered' in note:
+        note['pending'] = (output_digest, outline, profile)
+        return note
+    note['output_hash'] = output_digest.hexdigest()
+    if job['compress']:
+        try:
+            compress_output(job['out_file'], note['changed'])
+        except EnvironmentError as e:
+            note['error'] = get_diagnostic(note['file'], e)
+            return note
+    if outline is not None:
+        outline['tokens'] = tokenize([outline['title']] + outline['sections'])
+        note['outline'] = outline
+    if profile is not None:
+        profile['seconds'] = time.time() - profile['seconds']
+        note['profile'] = profile
+    return note
+
+
+def get_compressed_suffixes():
+    if brotli is None:
+        return ['.gz']
+    return ['.gz', '.br']
+
+
+def is_compression_missing(out_file):
+    return not all(os.path.exists(out_file + suffix) for suffix in get_compressed_suffixes())
+
+
+def compress_output(out_file, changed):
+    if not changed and not is_compression_missing(out_file):
+        return
+    with open(out_file, 'rb') as read:
+        write = open(out_file + '.gz.tmp', 'wb')
+        try:
+            gzipped = gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_LEVEL, fileobj=write, mtime=0)
+            for block in iter(lambda: read.read(SPILL_CHUNK_SIZE), ''):
+                gzipped.write(block)
+            gzipped.close()
+        finally:
+            write.close()
+        os.rename(out_file + '.gz.tmp', out_file + '.gz')
+        if brotli is not None:
+            read.seek(0)
+            compressor = brotli.Compressor()
+            with open(out_file + '.br.tmp', 'wb') as write:
+                for block in iter(lambda: read.read(SPILL_CHUNK_SIZE), ''):
+                    write.write(compressor.process(block))
+                write.write(compressor.finish())
+            os.rename(out_file + '.br.tmp', out_file + '.br')
+
+
+def new_profile():
+    return {
+        'seconds': time.time(),
+        'parse_seconds': 0.0,
+        'write_seconds': 0.0,
+        'lines': 0,
+        'code_lines': 0,
+        'sections': 0,
+        'images': 0,
+        'bytes_in': 0,
+        'bytes_out': 0,
+        'cached': False,
+    }
+
+
+def profiled_lines(lines, profile):
+    count = 0
+    size = 0
+    for line in lines:
+        count += 1
+        size += len(line)
+        yield line
+    profile['lines'] = count
+    profile['bytes_in'] = size
+
+
+def profiled_events(events, profile):
+    counts = dict.fromkeys(['section', 'text', 'image', 'code', 'code_start', 'code_line', 'code_end', 'code_unclosed'], 0)
+    for event in events:
+        counts[event[0]] += 1
+        yield event
+    profile['sections'] = counts['section']
+    profile['images'] = counts['image']
+    profile['code_lines'] = counts['code'] + counts['code_start'] + counts['code_line'] + counts['code_end']
+
+
+def recorded_images(events, images):
+    for event in events:
+        if event[0] == 'image':
+            images[event[2]] = get_image_state(event[2])
+        yield event
+
+
+def profiled_chunks(chunks, profile):
+    iter_chunks = iter(chunks)
+    start = time.time()
+    first = next(iter_chunks, None)
+    parsed = time.time()
+    size = 0
+    if first is not None:
+        size = len(first)
+        yield first
+        for chunk in iter_chunks:
+            size += len(chunk)
+            yield chunk
+    profile['parse_seconds'] = parsed - start
+    profile['write_seconds'] = time.time() - parsed
+    profile['bytes_out'] = size
+
+
+def print_profile(stages, profiles, top):
+    print 'Profile: %s, %d note(s) rendered' % (', '.join('%s %.3fs' % stage for stage in stages), len(profiles))
+    if not profiles:
+        return
+    print '%10s %10s %10s %9s %9s %9s %7s %11s %11s  %s' % ('seconds', 'parse', 'write', 'lines', 'code', 'sections', 'images', 'bytes in', 'bytes out', 'note')
+    for a_file, profile in sorted(profiles, key=lambda item: -item[1]['seconds'])[:top]:
+        print '%10.4f %10.4f %10.4f %9d %9d %9d %7d %11d %11d  %s%s' % (
+            profile['seconds'], profile['parse_seconds'], profile['write_seconds'], profile['lines'], profile['code_lines'], profile['sections'],
+            profile['images'], profile['bytes_in'], profile['bytes_out'], a_file, ' (cached)' if profile['cached'] else '')
+
+
+def clean_ast_cache(ast_cache, hashes):
+    if not os.path.exists(ast_cache):
+        return
+    for name in os.listdir(ast_cache):
+        if os.path.splitext(name)[0] not in hashes:
+            os.remove(os.path.join(ast_cache, name))
+
+
+def write_if_changed(out_file, chunks, digest):
+    try:
+        existing = open(out_file, 'rb')
+    except IOError:
+        existing = None
+    tmp_file = out_file + '.tmp'
+    write = None
+    matched = 0
+    try:
+        for chunk in chunks:
+            digest.update(chunk)
+            if write is None and existing is not None and existing.read(len(chunk)) == chunk:
+                matched += len(chunk)
+                continue
+            if write is None:
+                write = start_rewrite(tmp_file, existing, matched)
+            write.write(chunk)
+        if write is None:
+            if existing is not None and existing.read(1) == '':
+                return False
+            write = start_rewrite(tmp_file, existing, matched)
+        write.close()
+        os.rename(tmp_file, out_file)
+        return True
+    except Exception:
+        if write is not None:
+            write.close()
+            os.remove(tmp_file)
+        raise
+    finally:
+        if existing is not None:
+            existing.close()
+
+
+def start_rewrite(tmp_file, existing, matched):
+    write = open(tmp_file, 'wb')
+    if matched:
+        existing.seek(0)
+        while matched:
+            block = existing.read(min(matched, SPILL_CHUNK_SIZE))
+            write.write(block)
+            matched -= len(block)
+    return write
+
+
+def find_notes(src_dir):
+    return [a_file for a_file, stat_result in scan_notes(src_dir)]
+
+
+def scan_notes(src_dir, with_stat=False):
+    return scan_dir(src_dir, '', load_ignore_rules(src_dir), with_stat)
+
+
+def scan_dir(directory, relative, rules, with_stat):
+    for key, name, is_dir, stat_result in list_dir(directory, with_stat):
+        if rules and is_ignored(relative + name, is_dir, rules):
+            continue
+        path = os.path.join(directory, name)
+        if is_dir:
+            for item in scan_dir(path, relative + name + '/', rules, with_stat):
+                yield item
+        else:
+            yield path, stat_result
+
+
+def list_dir(directory, with_stat):
+    if scandir is None:
+        return list_dir_with_stat(directory)
+    entries = []
+    try:
+        for entry in scandir(directory):
+            is_dir = entry.is_dir()
+            if is_dir and entry.is_symlink():
+                continue
+            if is_dir or os.path.splitext(entry.name)[1] == '.txt':
+                entries.append((entry.name + '/' if is_dir else entry.name, entry.name, is_dir, get_entry_stat(entry) if with_stat and not is_dir else None))
+    except OSError:
+        return []
+    return sorted(entries)
+
+
+def get_entry_stat(entry):
+    try:
+        return entry.stat()
+    except OSError:
+        return None
+
+
+def list_dir_with_stat(directory):
+    entries = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return entries
+    for name in names:
+        path = os.path.join(directory, name)
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            stat_result = None
+        is_dir = stat_result is not None and stat.S_ISDIR(stat_result.st_mode)
+        if is_dir and os.path.islink(path):
+            continue
+        if is_dir or os.path.splitext(name)[1] == '.txt':
+            entries.append((name + '/' if is_dir else name, name, is_dir, stat_result))
+    return sorted(entries)
+
+
+def load_ignore_rules(src_dir):
+    rules = []
+    path = os.path.join(src_dir, IGNORE_FILE)
+    if not os.path.exists(path):
+        return rules
+    with open(path) as read:
+        for line in read:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            rules.append((line.strip('/'), '/' in line.rstrip('/'), line.endswith('/')))
+    return rules
+
+
+def is_ignored(relative, is_dir, rules):
+    name = relative[relative.rfind('/') + 1:]
+    for pattern, anchored, dir_only in rules:
+        if dir_only and not is_dir:
+            continue
+        if fnmatch.fnmatchcase(relative if anchored else name, pattern):
+            return True
+    return False
+
+
+def is_ignored_path(relative, rules):
+    parts = relative.replace(os.sep, '/').split('/')
+    for i in range(1, len(parts) + 1):
+        if is_ignored('/'.join(parts[:i]), i < len(parts), rules):
+            return True
+    return False
+
+
+def find_files(src_dir, extensions):
+    return sorted(os.path.join(dp, f) for dp, dn, filenames in os.walk(src_dir) for f in filenames if f.lower().endswith(extensions))
+
+
+def get_out_file(a_file, src_dir, dst_dir):
+    return dst_dir + '/' + a_file.replace(src_dir, '').replace('.txt', '.html')
+
+
+def make_out_dir(out_file):
+    if not os.path.exists(out_file[:out_file.rindex('/')]):
+        os.makedirs(out_file[:out_file.rindex('/')])
+
+
+def expand_includes(lines, a_file, src_dir, includes, stack=None, line_map=None):
+    stack = stack or [os.path.abspath(a_file)]
+    expanded = 0
+    for number, line in enumerate(lines, 1):
+        if '#include ' in line:
+            match = INCLUDE_PATTERN.match(line)
+            if match is not None:
+                column = len(match.group(1)) + 1
+                if line_map is not None:
+                    line_map.append((expanded + 1, number, 0, column))
                 try:
-                    write.write(parse(read.readlines()))
-                except Exception as e:
-                    print 'Error when parsing [%s] [%s]' % (a_file, str(e))
+                    for included in read_include(match, stack, src_dir, includes):
+                        expanded += 1
+                        yield included
+                except ParseError as e:
+                    if len(stack) == 1:
+                        e.line = expanded + 1
+                        e.column = column
+                    raise
+                if line_map is not None:
+                    line_map.append((expanded + 1, number + 1, 1, None))
+                continue
+        expanded += 1
+        yield line
+
+
+def read_include(match, stack, src_dir, includes):
+    indentation, name = match.groups()
+    path = os.path.abspath(os.path.join(src_dir, name))
+    key = os.path.relpath(path, os.path.abspath(src_dir))
+    if key.startswith(os.pardir):
+        raise ParseError('Include [%s] is outside [%s]' % (name, src_dir), 'include_outside')
+    if path in stack:
+        raise ParseError('Include cycle [%s]' % ' -> '.join(os.path.relpath(item, os.path.abspath(src_dir)) for item in stack + [path]), 'include_cycle')
+    try:
+        read = open(path)
+    except IOError:
+        raise ParseError('Missing include [%s]' % name, 'missing_include')
+    with read:
+        stat = os.fstat(read.fileno())
+        includes[key] = [stat.st_mtime, stat.st_size]
+        for line in expand_includes(read, path, src_dir, includes, stack + [path]):
+            yield indentation + line if indentation and line.strip() else line
+
+
+def hash_lines(lines):
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line)
+    return digest.hexdigest()
+
+
+def hashed_lines(lines, digest):
+    for line in lines:
+        digest.update(line)
+        yield line
+
+
+def tokenize(texts):
+    tokens = set()
+    for text in texts:
+        if text is not None:
+            tokens.update(TOKEN_PATTERN.findall(MARKUP_PATTERN.sub(' ', text).lower()))
+    return sorted(tokens)
+
+
+def write_site_index(src_dir, dst_dir, site_index, compress=False):
+    out_file = dst_dir + '/' + SITE_INDEX_PAGE
+    if os.path.exists(os.path.join(src_dir, os.path.splitext(SITE_INDEX_PAGE)[0] + '.txt')):
+        print 'Not writing [%s], a note already renders to it' % out_file
+    else:
+        changed = write_if_changed(out_file, iter_site_index_page(site_index), hashlib.sha1())
+        if compress:
+            compress_output(out_file, changed)
+
+    keys = sorted(site_index)
+    inverted = {}
+    for i, key in enumerate(keys):
+        for token in site_index[key]['tokens']:
+            inverted.setdefault(token, []).append(i)
+    search_index = {
+        'notes': [[get_note_url(key), site_index[key]['title']] for key in keys],
+        'tokens': inverted,
+    }
+    changed = write_if_changed(dst_dir + '/' + SEARCH_INDEX, iter([json.dumps(search_index, separators=(',', ':'), sort_keys=True)]), hashlib.sha1())
+    if compress:
+        compress_output(dst_dir + '/' + SEARCH_INDEX, changed)
+
+
+def iter_site_index_page(site_index):
+    box = TEMPLATES['box']
+    entry = TEMPLATES['entry']
+    indentation = build_indentation('second_level', False)
+    toc = []
+    body = []
+    for key in sorted(site_index):
+        outline = site_index[key]
+        title = cgi.escape(outline['title'] or key)
+        url = get_note_url(key)
+        text = [indentation + render_template(entry, {'text': '<a href=\'%s\'>%s</a>' % (url, title)})]
+        for section in outline['sections']:
+            link = '<a href=\'%s#%s\'>%s</a>' % (url, escape_single_quoted_attr_value(section), section)
+            text.append(indentation + render_template(entry, {'text': link}))
+        toc.append(toc_entry(title))
+        body.extend(build_box(box, title, text))
+    return render_body(SITE_INDEX_TITLE, toc, body)
+
+
+def get_note_url(key):
+    return '/' + os.path.splitext(key)[0].replace(os.sep, '/') + '.html'
+
+
+def load_state(dst_dir, name):
+    try:
+        with open(os.path.join(dst_dir, name)) as read:
+            return json.load(read, object_hook=encode_object)
+    except (IOError, ValueError):
+        return {}
+
+
+def encode_object(obj):
+    return dict((key.encode('utf-8'), encode_value(value)) for key, value in obj.items())
+
+
+def encode_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [encode_value(item) for item in value]
+    return value
+
+
+def save_state(dst_dir, name, state):
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+    path = os.path.join(dst_dir, name)
+    with open(path + '.tmp', 'w') as write:
+        write.write(json.dumps(state))
+    os.rename(path + '.tmp', path)
+
+
+def hash_render_settings():
+    assets = {'enabled': ASSETS['dir'] is not None, 'shell': ASSETS['shell'], 'thumbnails': ASSETS['thumbnails']}
+    return hash_lines([TEMPLATES[name][2] for name in sorted(TEMPLATES)] + [json.dumps(assets, sort_keys=True)])
+
+
+def load_manifest(dst_dir):
+    try:
+        with open(os.path.join(dst_dir, MANIFEST)) as read:
+            manifest = json.load(read, object_hook=encode_object)
+    except (IOError, ValueError):
+        return {}
+    if manifest.get('version') != MANIFEST_VERSION:
+        return {}
+    notes = manifest['notes']
+    if manifest.get('render_settings') != hash_render_settings():
+        for entry in notes.values():
+            entry['stale'] = True
+    return notes
+
+
+def save_manifest(dst_dir, notes):
+    save_state(dst_dir, MANIFEST, {'version': MANIFEST_VERSION, 'render_settings': hash_render_settings(), 'notes': notes})
 
 
 def parse(param):
+    return ''.join(render_note(build_note(param)))
+
+
+def build_note(param):
+    if not param:
+        raise ParseError('Empty note', 'empty', 1, 1)
     title = get_title(param)
-    if title['is_narrative']:
-        body, toc = get_list_body(param, BOX_NARRATIVE, TEXT_BOX_NARRAtIVE, True)
-    else:
-        body, toc = get_list_body(param, BOX, SECOND_LEVEL_ENTRY, False)
+    iter_text = iter(param)
+    next(iter_text)
+    return title['value'], title['is_narrative'], list(iter_note_events(iter_text, title['is_narrative']))
 
-    return BODY % (title['value'], title['value'], toc, body)
+
+def render_note(note, outline=None):
+    title, is_narrative, events = note
+    html = []
+    toc = []
+    render_sections(events, is_narrative, html.extend, toc, outline)
+    if outline is not None:
+        outline['title'] = title
+    return render_body(title, toc, html)
+
+
+def parse_stream(lines, outline=None, ast_file=None, profile=None, images=None):
+    iter_lines = iter(lines)
+    try:
+        first_line = next(iter_lines)
+    except StopIteration:
+        raise ParseError('Empty note', 'empty', 1, 1)
+    title = get_title([first_line])
+    events = iter_note_events(iter_lines, title['is_narrative'])
+    if profile is not None:
+        events = profiled_events(events, profile)
+    if images is not None:
+        events = recorded_images(events, images)
+    if ast_file is not None:
+        events = dump_events(ast_file, title['value'], title['is_narrative'], events)
+    return stream_events(title['value'], title['is_narrative'], events, outline)
+
+
+def parse_cached(ast_file, outline=None, profile=None, images=None):
+    header = marshal.load(ast_file)
+    if header[0] != AST_VERSION:
+        raise ValueError('Unsupported AST version [%s]' % header[0])
+    events = load_events(ast_file)
+    if profile is not None:
+        events = profiled_events(events, profile)
+    if images is not None:
+        events = recorded_images(events, images)
+    return stream_events(header[1], header[2], events, outline)
+
+
+def dump_events(ast_file, title, is_narrative, events):
+    marshal.dump((AST_VERSION, title, is_narrative), ast_file)
+    batch = []
+    for event in events:
+        batch.append(event)
+        if len(batch) == EVENT_BATCH_SIZE:
+            marshal.dump(batch, ast_file)
+            batch = []
+        yield event
+    if batch:
+        marshal.dump(batch, ast_file)
+    marshal.dump(None, ast_file)
+
+
+def load_events(ast_file):
+    batch = marshal.load(ast_file)
+    while batch is not None:
+        for event in batch:
+            yield event
+        batch = marshal.load(ast_file)
+
+
+def stream_events(title, is_narrative, events, outline):
+    toc = []
+    spill = tempfile.SpooledTemporaryFile(SPILL_MEMORY_SIZE)
+    try:
+        render_sections(events, is_narrative, spill.writelines, toc, outline)
+        if outline is not None:
+            outline['title'] = title
+        for chunk in render_body(title, toc, read_spill(spill)):
+            yield chunk
+    finally:
+        spill.close()
+
+
+def render_body(title, toc, body):
+    values = {'title': title, 'toc': toc, 'body': body}
+    for slot, name in SHELL_ASSETS.items():
+        values[slot] = ASSET_LINK % ASSETS['shell'].get(name, name)
+    return iter_template(TEMPLATES['body'], values)
+
+
+def read_spill(spill):
+    spill.seek(0)
+    return iter(lambda: spill.read(SPILL_CHUNK_SIZE), '')
+
+
+def get_box_names(is_narrative):
+    if is_narrative:
+        return 'box_narrative', 'paragraph'
+    return 'box', 'entry'
 
 
 BODY = '<!DOCTYPE html>\n' + \
        '<html>\n' + \
        '    <head>\n' + \
-       '        <title>%s</title>\n' + \
+       '        <title>{{title}}</title>\n' + \
        '        <meta http-equiv="Content-Type" content="text/html; charset=utf-8">\n' + \
-       '        <link rel="stylesheet" type="text/css" href="/assets/main.css">\n' \
-       '        <link rel="icon" type="image/png" sizes="32x32" href="/assets/favicon.png">\n' + \
-       '        <script src="/assets/syntaxhighlighter.js"></script>\n' \
+       '        <link rel="stylesheet" type="text/css" href="{{stylesheet}}">\n' \
+       '        <link rel="icon" type="image/png" sizes="32x32" href="{{favicon}}">\n' + \
+       '        <script src="{{script}}"></script>\n' \
        '    </head>\n' + \
        '    <body>\n' + \
        '        <fieldset class=\'box\'>\n' + \
-       '            <legend>%s ToC</legend>\n' + \
+       '            <legend>{{title}} ToC</legend>\n' + \
        '                <ul>\n' + \
-       '%s' + \
+       '{{toc}}' + \
        '                </ul>\n' + \
        '        </fieldset>\n' + \
-       '%s' + \
+       '{{body}}' + \
        '    <script>new Highlighter().run(document);</script>\n' \
        '    <script> (function(i,s,o,g,r,a,m){i[\'GoogleAnalyticsObject\']=r;i[r]=i[r]||function(){ (i[r].q=i[r].q||[]).push(arguments)},i[r].l=1*new Date();a=s.createElement(o), m = s.getElementsByTagName(o)[0];a.async=1;a.src=g;m.parentNode.insertBefore(a,m) })(window,document,\'script\',\'https://www.google-analytics.com/analytics.js\',\'ga\'); ga(\'create\', \'UA-106217827-1\', \'auto\'); ga(\'send\', \'pageview\'); </script>\n' + \
        '    </body>\n' + \
        '</html>'
 
 BOX = '        <fieldset class=\'box\'>\n' + \
-      '            <a name=\'%s\'></a>\n' + \
-      '            <legend>%s</legend>\n' + \
+      '            <a name=\'{{anchor}}\'></a>\n' + \
+      '            <legend>{{title}}</legend>\n' + \
       '                <ul>\n' \
-      '%s' + \
+      '{{text}}' + \
       '                </ul>\n' + \
       '        </fieldset>\n'
 
 BOX_NARRATIVE = \
     '        <fieldset class=\'box\'>\n' + \
-    '            <a name=\'%s\'></a>\n' + \
-    '            <legend>%s</legend>\n' + \
-    '%s' + \
+    '            <a name=\'{{anchor}}\'></a>\n' + \
+    '            <legend>{{title}}</legend>\n' + \
+    '{{text}}' + \
     '        </fieldset>\n'
 
 INDENTATION = '    '
-SECOND_LEVEL_ENTRY = '<li><span>%s</span></li>\n'
-THIRD_LEVEL_ENTRY = '<ul>\n                            <li><span>%s</span></li>\n                        </ul>\n'
+SECOND_LEVEL_ENTRY = '<li><span>{{text}}</span></li>\n'
+THIRD_LEVEL_ENTRY = '<ul>\n                            <li><span>{{text}}</span></li>\n                        </ul>\n'
 ENTRY_BLOCK = '                        <ul>\n%s                        </ul>\n'
-TEXT_BOX_NARRAtIVE = '<p>%s</p>\n'
+TEXT_BOX_NARRAtIVE = '<p>{{text}}</p>\n'
 ENTRY_CODE_START = '                <pre><code>'
 ENTRY_CODE_END = '</code></pre>\n'
+TOC_ENTRY = '                    <li><span><a href=\'#{{anchor}}\'>{{title}}</a></span></li>\n'
+IMAGE = '<a href=\'{{link}}\'><img class=\'imgbody\' src=\'{{src}}\'{{attributes}}></a>'
 
-IMG_EXTENSIONS = [
+IMG_EXTENSIONS = (
     '.jpeg',
     '.jpg',
     '.png',
     '.gif',
-]
-IMG_LINK = '/assets/%s'
+)
+ASSET_LINK = '/assets/%s'
+IMG_LINK = ASSET_LINK
+THUMBNAIL_LINK = '/assets/thumbs/%s'
+IMG_ATTRIBUTES = ' width=\'%d\' height=\'%d\' loading=\'lazy\''
+
+SLOT_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+DEFAULT_TEMPLATES = {
+    'body': BODY,
+    'box': BOX,
+    'box_narrative': BOX_NARRATIVE,
+    'entry': SECOND_LEVEL_ENTRY,
+    'nested_entry': THIRD_LEVEL_ENTRY,
+    'paragraph': TEXT_BOX_NARRAtIVE,
+    'code_start': ENTRY_CODE_START,
+    'code_end': ENTRY_CODE_END,
+    'toc_entry': TOC_ENTRY,
+    'image': IMAGE,
+}
+
+LEVELS = {0: 'first_level', 4: 'second_level', 8: 'third_level'}
+CODE_TITLE_PATTERN = re.compile(r'\*[a-zA-Z0-9<>;&]+\*')
+
+# **bold**, or an escaped \* unless its star opens a **bold** run
+INLINE_PATTERN = re.compile(r'\*\*(.*?)\*\*|\\(?!\*\*.*?\*\*)\*')
+
+
+def compile_template(text):
+    parts = SLOT_PATTERN.split(text)
+    segments = tuple(parts[0::2])
+    slots = tuple(parts[1::2])
+    format_string = ''.join(segment.replace('%', '%%') + '%%(%s)s' % slot for segment, slot in zip(segments, slots))
+    return segments, slots, format_string + segments[-1].replace('%', '%%')
+
+
+def render_template(template, values):
+    return template[2] % values
+
+
+def iter_template(template, values):
+    segments, slots = template[:2]
+    yield segments[0]
+    for slot, segment in zip(slots, segments[1:]):
+        value = values[slot]
+        if isinstance(value, basestring):
+            yield value
+        else:
+            for chunk in value:
+                yield chunk
+        yield segment
+
+
+def load_templates(template_dir):
+    templates = {}
+    for name in DEFAULT_TEMPLATES:
+        path = os.path.join(template_dir, name + '.html')
+        if os.path.exists(path):
+            with open(path) as read:
+                templates[name] = compile_template(read.read())
+    return templates
+
 
 def get_title(param):
     if len(param) == 0:
@@ -94,11 +1819,17 @@ def get_title(param):
 
 
 def escape(line):
-    line = cgi.escape(line)
-    while re.search(r'\*\*(.*?)\*\*', line):
-        line = re.sub(r'\*\*(.*?)\*\*', '<strong>\\1</strong>', line.replace('\n', ''))
-    line = re.sub(r'\\\*', '*', line.replace('\n', ''))
-    return line
+    line = cgi.escape(line).replace('\n', '')
+    if '*' not in line:
+        return line
+    return INLINE_PATTERN.sub(format_inline, line)
+
+
+def format_inline(match):
+    strong = match.group(1)
+    if strong is None:
+        return '*'
+    return '<strong>' + strong.replace('\\*', '*') + '</strong>'
 
 
 def escape_single_quoted_attr_value(text):
@@ -121,118 +1852,195 @@ def build_indentation(next_level, is_narrative):
         return INDENTATION * 6
 
 
-def get_white_spacing(next_level):
-    if next_level == 'first_level':
-        return 0
-    elif next_level == 'second_level':
-        return 4
-    elif next_level == 'third_level':
-        return 8
-    else:
-        raise Exception("Could not find level " + next_level)
+def classify_line(line, in_code):
+    if '\t' in line:
+        line = tabs_to_spaces(line)
+    elif line.endswith('\n'):
+        line = line[:-1]
+    if in_code:
+        if is_image(line):
+            return None, 'image', line
+        return None, 'code_end' if line.endswith('*') else 'code', line
+    if line == '':
+        return None, 'blank', line
 
+    spaces = len(line) - len(line.lstrip(' '))
+    level = LEVELS.get(spaces)
+    if level is None:
+        raise ParseError('Unsupported number of spaces [%d] in line [%s]' % (spaces, line), 'indentation')
+    payload = line[spaces:] if spaces else line
+    if is_image(payload):
+        return level, 'image', payload
+    if payload.startswith('*') and not payload.startswith('**') and not CODE_TITLE_PATTERN.match(payload):
+        return level, 'code_line' if payload.endswith('*') else 'code_start', payload
+    return level, 'text', payload
 
-def line_finishes_code_block(current_level, line):
-    return current_level == 'code' and line.endswith('*')
 
+def is_image(line):
+    return line.startswith('#') and line.endswith('#') and line[1:-1].endswith(IMG_EXTENSIONS)
 
-def line_starts_code_block(current_level, line):
-    return line.startswith('*') and not line.startswith('**') and current_level != 'code' and not re.match('^\*[a-zA-Z0-9<>;&]+\*', line)
 
+def get_image_state(image):
+    asset = ASSETS['images'].get(image)
+    if ASSETS['dir'] is None or asset is None:
+        return None
+    return [asset['src'], asset['width'], asset['height']]
 
-def is_image(line):
-    if line.startswith("#") and line.endswith("#"):
-        image = line[1:-1]
-        return any(image.endswith(extension) for extension in IMG_EXTENSIONS)
-    return False
 
+def build_image(image):
+    link = IMG_LINK % image
+    if ASSETS['dir'] is None:
+        return render_template(TEMPLATES['image'], {'link': link, 'src': link, 'attributes': ''})
+    asset = ASSETS['images'].get(image)
+    if asset is None:
+        raise ParseError('Missing image [%s] in [%s]' % (image, ASSETS['dir']), 'missing_image')
+    attributes = IMG_ATTRIBUTES % (asset['width'], asset['height']) if asset['width'] is not None else ''
+    return render_template(TEMPLATES['image'], {'link': link, 'src': asset['src'], 'attributes': attributes})
 
-def build_image(line):
-    if line.startswith("#") and line.endswith("#"):
-        image = line[1:-1]
-        if any(image.endswith(extension) for extension in IMG_EXTENSIONS):
-            link = IMG_LINK % image
-            return "<a href='{1}'><img class='imgbody' src='{1}'></a>".format(link, link)
-    return False
 
+def toc_entry(title):
+    return render_template(TEMPLATES['toc_entry'], {'anchor': escape_single_quoted_attr_value(title), 'title': title})
 
-def get_list_body(param, body_box, paragraph_box, is_narrative):
-    iter_text = iter(param)
-    toc = ''
-    next(iter_text)
 
+def build_box(box, title, text):
+    return list(iter_template(box, {'anchor': str(escape_single_quoted_attr_value(title)), 'title': str(title), 'text': text}))
+
+
+def split_box(box, title):
+    segments, slots = box[:2]
+    if slots.count('text') != 1:
+        return None
+    values = {'anchor': str(escape_single_quoted_attr_value(title)), 'title': str(title)}
+    at = slots.index('text')
+    head = ''.join(segment + values[slot] for segment, slot in zip(segments[:at], slots[:at])) + segments[at]
+    tail = segments[at + 1] + ''.join(values[slot] + segment for slot, segment in zip(slots[at + 1:], segments[at + 2:]))
+    return head, tail
+
+
+class ParseError(Exception):
+    def __init__(self, message, rule, line=None, column=None):
+        Exception.__init__(self, message)
+        self.rule = rule
+        self.line = line
+        self.column = column
+
+
+def iter_note_events(iter_text, is_narrative):
     current_level = 'start'
-    html = ''
     title = None
-    text = ''
-    for line in iter_text:
-        try:
-            line = tabs_to_spaces(line)
-            if line == '' and current_level != 'code':
+    title_number = None
+    entries = 0
+    number = 1
+    raw = ''
+    try:
+        for number, raw in enumerate(iter_text, 2):
+            level, kind, line = classify_line(raw, current_level == 'code')
+            if kind == 'blank':
                 continue
-
-            if current_level != 'code':
-                next_level = find_level(line)
-                line = line[get_white_spacing(next_level):]
-
-            if is_image(line):
-                text += build_indentation(next_level, is_narrative) + build_image(line) + '\n'
-            elif line_finishes_code_block(current_level, line):
-                text += escape(line[:-1]) + ENTRY_CODE_END
-                current_level = 'nocode'
-                next_level = 'nocode'
-            elif current_level == 'code':
-                text += escape(line) + '\n'
-            elif line_starts_code_block(current_level, line):
-                if line.endswith('*'):
-                    text += ENTRY_CODE_START + escape(line[1:-1]) + ENTRY_CODE_END
+            if level is not None:
+                next_level = level
+            try:
+                if kind == 'image':
+                    if build_indentation(next_level, is_narrative) is None:
+                        raise ParseError('Unsupported image in level [%s]' % next_level, 'image_level')
+                    entries += 1
+                    yield 'image', next_level, line[1:-1]
+                elif kind == 'code_end':
+                    yield 'code_end', escape(line[:-1])
+                    current_level = 'nocode'
+                    next_level = 'nocode'
+                elif kind == 'code':
+                    yield 'code_line', escape(line)
+                elif kind == 'code_line':
+                    entries += 1
+                    yield 'code', escape(line[1:-1])
                     current_level = next_level
-                else:
-                    text += ENTRY_CODE_START + escape(line[1:]) + '\n'
+                elif kind == 'code_start':
+                    entries += 1
+                    yield 'code_start', escape(line[1:])
                     next_level = 'code'
-            elif next_level == 'first_level':
-                if current_level != 'start':
-                    html += body_box % (escape_single_quoted_attr_value(title), title, text)
-                    toc += '                    <li><span><a href=\'#%s\'>%s</a></span></li>\n' % (escape_single_quoted_attr_value(title), title)
-                    text = ''
-                title = escape(line)
-            elif next_level == 'second_level':
-                text += build_indentation(next_level, is_narrative) + paragraph_box % escape(line)
-            elif next_level == 'third_level':
-                text += build_indentation(next_level, is_narrative) + THIRD_LEVEL_ENTRY % escape(line)
-            else:
-                raise Exception('Unsupported state current level[%s] nextLevel[%s]' % (current_level, next_level))
-            if current_level != 'code':
-                current_level = next_level
+                elif next_level == 'first_level':
+                    title = escape(line)
+                    title_number = number
+                    entries = 0
+                    yield 'section', title
+                elif next_level == 'second_level' or next_level == 'third_level':
+                    entries += 1
+                    yield 'text', next_level, escape(line)
+                else:
+                    raise ParseError('Unsupported state current level[%s] nextLevel[%s]' % (current_level, next_level), 'state')
+                if current_level != 'code':
+                    current_level = next_level
 
-        except Exception as e:
-            raise Exception('%s in line [%s]' % (str(e), line))
+            except Exception as e:
+                raise ParseError('%s in line [%s]' % (str(e), line), getattr(e, 'rule', 'syntax'))
+    except ParseError as e:
+        if e.line is None:
+            e.line = number
+            e.column = len(raw) - len(raw.lstrip(' \t')) + 1
+        raise
 
-    if title is not None:
-        if text is '':
-            raise Exception('Failed to parse, found title[%s] with no text' % title)
-        toc += '                    <li><span><a href=\'#%s\'>%s</a></span></li>\n' % (escape_single_quoted_attr_value(title), title)
-        return html + body_box % (escape_single_quoted_attr_value(title), title, text), toc
-    else:
-        return html, toc
+    if current_level == 'code':
+        yield 'code_unclosed',
+    if title is not None and not entries:
+        raise ParseError('Failed to parse, found title[%s] with no text' % title, 'empty_section', title_number, 1)
 
 
-def find_level(line):
-    spaces = 0
-    for c in line:
-        if c == ' ':
-            spaces += 1
+def render_sections(events, is_narrative, writelines, toc, outline):
+    box_name, paragraph_name = get_box_names(is_narrative)
+    box = TEMPLATES[box_name]
+    templates = {'second_level': TEMPLATES[paragraph_name], 'third_level': TEMPLATES['nested_entry']}
+    indentations = {'second_level': build_indentation('second_level', is_narrative), 'third_level': build_indentation('third_level', is_narrative)}
+    code_start = render_template(TEMPLATES['code_start'], {})
+    code_end = render_template(TEMPLATES['code_end'], {})
+    title = None
+    started = False
+    parts = None
+    text = []
+    for event in events:
+        kind = event[0]
+        if kind == 'code_line':
+            text.append('\n' + event[1])
+        elif kind == 'text':
+            text.append(indentations[event[1]] + render_template(templates[event[1]], {'text': event[2]}))
+        elif kind == 'image':
+            text.append(indentations[event[1]] + build_image(event[2]) + '\n')
+        elif kind == 'code':
+            text.append(code_start + event[1] + code_end)
+        elif kind == 'code_start':
+            text.append(code_start + event[1])
+        elif kind == 'code_end':
+            text.append('\n' + event[1] + code_end)
+        elif kind == 'code_unclosed':
+            text.append('\n')
         else:
-            break
-    if spaces == 0:
-        return 'first_level'
-    elif spaces == 4:
-        return 'second_level'
-    elif spaces == 8:
-        return 'third_level'
+            if started or text:
+                close_section(box, title, text, parts, writelines, toc, outline)
+            title = event[1]
+            started = True
+            parts = split_box(box, title)
+            text = [parts[0]] if parts is not None else []
+        if parts is not None and len(text) >= RENDER_BATCH_SIZE:
+            writelines(text)
+            text = []
+    if started:
+        close_section(box, title, text, parts, writelines, toc, outline)
+
+
+def close_section(box, title, text, parts, writelines, toc, outline):
+    if parts is None:
+        writelines(build_box(box, title, text))
     else:
-        raise Exception("Unsupported number of spaces [%d]" % spaces)
+        text.append(parts[1])
+        writelines(text)
+    toc.append(toc_entry(title))
+    if outline is not None:
+        outline['sections'].append(title)
+
+
+TEMPLATES = dict((name, compile_template(text)) for name, text in DEFAULT_TEMPLATES.items())
+ASSETS = {'dir': None, 'images': {}, 'shell': {}, 'thumbnails': None}
 
 
 if __name__ == "__main__":
-    run()
+    sys.exit(run())
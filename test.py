@@ -1,11 +1,25 @@
+import gzip
+import hashlib
+import httplib
+import json
+import os
+import pstats
 import re
+import shutil
 import string
+import struct
+import subprocess
+import StringIO
 import sys
+import tempfile
+import threading
 import unittest
+import zipfile
 
 from mock import mock, MagicMock, patch
 
-from notes2html import parse, run
+import notes2html
+from notes2html import Image, LRUCache, brotli, ParseError, TEMPLATES, build, compile_template, convert_many, load_templates, render_template, write_if_changed, escape, iter_inotify_changes, iter_polled_changes, make_bundle_server, make_server, find_notes, parse, parse_stream, read_image_size, run
 
 
 class ParserTest(unittest.TestCase):
@@ -410,8 +424,10 @@ class ParserTest(unittest.TestCase):
         sys.argv = ['bin', 'in']
         self.assertRaises(Exception, run)
 
+    @mock.patch('sys.stdout')
+    @mock.patch('notes2html.scandir', None)
     @mock.patch('notes2html.os.listdir')
-    def test_whenEmptyFiles_thenFilesOpen(self, mock_listdir):
+    def test_whenEmptyFiles_thenFilesOpen(self, mock_listdir, mock_stdout):
         sys.argv = ['bin', 'in', 'out', 'out']
         mock_listdir.return_value = ['a.txt']
         with patch('notes2html.open', create=True) as mock_open:
@@ -1522,6 +1538,30 @@ class ParserTest(unittest.TestCase):
             '</html>'
         )
 
+    def test_whenParsedAsStream_thenSameMarkupAsParse(self):
+        lines = string.split('*alpha*\nbravo\n    charlie\n    *delta\n    echo*\nfoxtrot\n    golf\n        hotel', '\n')
+        self.assertEqual(parse(lines), ''.join(parse_stream(iter(lines))))
+
+    @patch('notes2html.RENDER_BATCH_SIZE', 2)
+    def test_whenSectionsStreamedInBatches_thenSameMarkupAsParse(self):
+        lines = string.split('before\n*alpha*\nbravo\n    charlie\n        delta\n    *echo\n    foxtrot\n    golf\nhotel\n    #india.png#', '\n')
+        self.assertEqual(parse(lines), ''.join(parse_stream(iter(lines))))
+
+    def test_whenParsedAsStreamAndLineUnsupported_thenExceptionThrown(self):
+        with self.assertRaisesRegexp(Exception, re.escape('Unsupported number of spaces [1] in line [ bravo]')):
+            ''.join(parse_stream(iter(['*alpha*', ' bravo'])))
+
+    def test_whenLineUnsupported_thenErrorCarriesLocationAndRule(self):
+        with self.assertRaises(ParseError) as context:
+            parse(['*alpha*', 'bravo', '    charlie', '\t  delta'])
+        self.assertEqual((4, 4, 'indentation'), (context.exception.line, context.exception.column, context.exception.rule))
+        self.assertEqual('Unsupported number of spaces [3] in line [   delta]', str(context.exception))
+
+    def test_whenLastTitleHasNoText_thenErrorPointsAtTitle(self):
+        with self.assertRaises(ParseError) as context:
+            parse(['*alpha*', 'bravo', '    charlie', 'delta', ''])
+        self.assertEqual((4, 1, 'empty_section'), (context.exception.line, context.exception.column, context.exception.rule))
+
     def assert_markup_generated(self, input, expected):
         actual = parse(string.split(input, '\n'))
         a = actual.split("\n")
@@ -1533,3 +1573,723 @@ class ParserTest(unittest.TestCase):
     def assert_exception_thrown(self, input, message):
         with self.assertRaisesRegexp(Exception, re.escape(message)):
             parse(string.split(input, '\n'))
+
+
+class EscapeTest(unittest.TestCase):
+    def test_whenMultipleStrongBlocks_thenAllReplaced(self):
+        self.assertEqual('<strong>a</strong> &amp; <strong>b</strong>', escape('**a** & **b**\n'))
+
+    def test_whenEscapedStarInsideStrongBlock_thenStarUnescaped(self):
+        self.assertEqual('<strong>a*b</strong> *', escape('**a\\*b** \\*'))
+
+    def test_whenEscapedStarOpensStrongBlock_thenStrongBlockWins(self):
+        self.assertEqual('\\<strong>a</strong>', escape('\\**a**'))
+
+    def test_whenUnbalancedStars_thenLeftUntouched(self):
+        self.assertEqual('***', escape('***'))
+
+
+class TemplateTest(unittest.TestCase):
+    def test_whenTemplateHasSlotsAndPercentSigns_thenSlotsFilled(self):
+        template = compile_template('<p style="width: 100%">{{text}} {{text}}</p>')
+        self.assertEqual('<p style="width: 100%">a b a b</p>', render_template(template, {'text': 'a b'}))
+
+    def test_whenTemplateFileProvided_thenTemplateOverridden(self):
+        template_dir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(template_dir, 'entry.html'), 'w') as write:
+                write.write('<li>{{text}}</li>\n')
+            with patch.dict(TEMPLATES, load_templates(template_dir)):
+                self.assertIn('    <li>bravo</li>\n', parse(['*t*', 'alpha', '    bravo']))
+        finally:
+            shutil.rmtree(template_dir)
+
+
+class ConvertManyTest(unittest.TestCase):
+    NOTES = [
+        ('a', '*alpha*\nbravo\n    charlie\ndelta\n    echo\n'),
+        ('b', '*foxtrot*\n golf\n'),
+        ('c', ''),
+    ]
+
+    def test_whenNotesConverted_thenHtmlTocAndErrorsReturnedInOrder(self):
+        results = list(convert_many(iter(self.NOTES)))
+        self.assertEqual(('a', parse(self.NOTES[0][1].split('\n')), ['bravo', 'delta'], []), results[0])
+        self.assertEqual(('b', None, [], ['Unsupported number of spaces [1] in line [ golf]']), results[1])
+        self.assertEqual(['a', 'b', 'c'], [result[0] for result in results])
+        self.assertIsNone(results[2][1])
+        self.assertEqual(['Empty note'], results[2][3])
+
+    def test_whenNotesConvertedInPool_thenSameResults(self):
+        self.assertEqual(list(convert_many(self.NOTES)), list(convert_many(iter(self.NOTES * 3), 2))[:3])
+
+    def test_whenNotesConvertedInPool_thenUnsizedInputReadInBatches(self):
+        consumed = []
+
+        def notes():
+            for index in range(notes2html.POOL_CHUNK_SIZE * 8):
+                consumed.append(index)
+                yield 'n%d' % index, '*title*\n'
+        results = convert_many(notes(), 2)
+        self.assertEqual('n0', next(results)[0])
+        self.assertEqual(notes2html.POOL_CHUNK_SIZE * 4, len(consumed))
+        self.assertEqual(notes2html.POOL_CHUNK_SIZE * 8 - 1, len(list(results)))
+
+
+class BuildTest(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.dst_dir = tempfile.mkdtemp()
+        self.write_note('a.txt', '*alpha*\nbravo\n    charlie\n')
+        self.write_note('b.txt', '*delta*\necho\n    foxtrot\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.src_dir)
+        shutil.rmtree(self.dst_dir)
+
+    def write_note(self, name, text):
+        with open(os.path.join(self.src_dir, name), 'w') as write:
+            write.write(text)
+
+    def build(self, *options):
+        sys.argv = ['bin'] + list(options) + [self.src_dir, self.dst_dir]
+        run()
+
+    def read_output(self, name):
+        with open(os.path.join(self.dst_dir, name)) as read:
+            return read.read()
+
+    def test_whenNothingChanged_thenNotesNotParsedAgain(self):
+        self.build('--incremental')
+        with patch('notes2html.parse_stream') as mock_parse:
+            self.build('--incremental')
+            self.assertFalse(mock_parse.called)
+        self.assertTrue(os.path.exists(os.path.join(self.dst_dir, 'a.html')))
+
+    def test_whenOneNoteChanged_thenOnlyThatNoteParsed(self):
+        self.build('--incremental')
+        self.write_note('b.txt', '*delta*\necho\n    golf\n')
+        os.utime(os.path.join(self.src_dir, 'b.txt'), (0, 0))
+        with patch('notes2html.parse_stream', return_value=[]) as mock_parse:
+            self.build('--incremental')
+            self.assertEqual(1, mock_parse.call_count)
+
+    def test_whenNoteRemoved_thenOutputDeleted(self):
+        self.build('--incremental')
+        os.remove(os.path.join(self.src_dir, 'b.txt'))
+        self.build('--incremental')
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'b.html')))
+        self.assertTrue(os.path.exists(os.path.join(self.dst_dir, 'a.html')))
+
+    def test_whenBuiltWithJobs_thenSameOutputAsSequentialBuild(self):
+        for i in range(8):
+            self.write_note('n%d.txt' % i, '*note %d*\ntitle\n    text %d\n' % (i, i))
+        self.build()
+        expected = dict((name, self.read_output(name)) for name in os.listdir(self.dst_dir))
+        shutil.rmtree(self.dst_dir)
+        self.build('--jobs', '3')
+        self.assertEqual(expected, dict((name, self.read_output(name)) for name in os.listdir(self.dst_dir)))
+
+    @patch('notes2html.PIPELINE_DEPTH', 2)
+    def test_whenBuiltWithPipeline_thenSameOutputAsSequentialBuild(self):
+        for i in range(8):
+            self.write_note('n%d.txt' % i, '*note %d*\ntitle\n    text %d\n' % (i, i))
+        self.build('--index')
+        expected = dict((name, self.read_output(name)) for name in os.listdir(self.dst_dir) if name.endswith('.html'))
+        shutil.rmtree(self.dst_dir)
+        self.build('--index', '--pipeline')
+        self.assertEqual(expected, dict((name, self.read_output(name)) for name in os.listdir(self.dst_dir) if name.endswith('.html')))
+
+    @patch('sys.stdout')
+    @patch('notes2html.PIPELINE_BUFFER_SIZE', 40)
+    def test_whenBuiltWithPipelineAndNotesFail_thenErrorsReportedInPathOrder(self, mock_stdout):
+        self.write_note('c.txt', '*bad*\n' + '    padding\n' * 8 + '  bad\n')
+        self.write_note('d.txt', '*bad*\n  bad\n')
+        self.build('--incremental', '--pipeline')
+        output = ''.join(call[0][0] for call in mock_stdout.write.call_args_list)
+        self.assertEqual(['c.txt', 'd.txt'], re.findall(r'/(\w\.txt)\]', output))
+        self.assertEqual(['a.html', 'b.html'], sorted(name for name in os.listdir(self.dst_dir) if name.endswith('.html')))
+
+    @patch('notes2html.brotli', None)
+    def test_whenBuiltWithBundle_thenPagesStoredInDeterministicArchive(self):
+        bundle = os.path.join(self.dst_dir, 'site.zip')
+        self.build('--incremental', '--compress', '--bundle', bundle)
+        with open(bundle, 'rb') as read:
+            first = read.read()
+        archive = zipfile.ZipFile(bundle)
+        self.assertEqual(['a.html', 'a.html.gz', 'b.html', 'b.html.gz'], sorted(info.filename for info in archive.infolist()))
+        self.assertEqual([zipfile.ZIP_STORED], list(set(info.compress_type for info in archive.infolist())))
+        self.assertEqual(self.read_output('a.html'), archive.read('a.html'))
+        self.build('--incremental', '--compress', '--bundle', bundle)
+        with open(bundle, 'rb') as read:
+            self.assertEqual(first, read.read())
+
+    def test_whenBundleRebuilt_thenOnlyChangedPagesRepacked(self):
+        bundle = os.path.join(self.dst_dir, 'site.zip')
+        self.build('--incremental', '--bundle', bundle)
+        with patch('notes2html.pack_file') as mock_pack:
+            self.build('--incremental', '--bundle', bundle)
+            self.assertFalse(mock_pack.called)
+        self.write_note('b.txt', '*delta*\necho\n    golf\n')
+        with patch('notes2html.pack_file', wraps=notes2html.pack_file) as mock_pack:
+            self.build('--incremental', '--bundle', bundle)
+            self.assertEqual(['b.html'], [call[0][1] for call in mock_pack.call_args_list])
+        archive = zipfile.ZipFile(bundle)
+        self.assertIsNone(archive.testzip())
+        self.assertEqual([self.read_output('a.html'), self.read_output('b.html')], [archive.read('a.html'), archive.read('b.html')])
+        os.remove(os.path.join(self.dst_dir, notes2html.BUNDLE_STATE))
+        with open(bundle, 'rb') as read:
+            repacked = read.read()
+        self.build('--incremental', '--bundle', bundle)
+        with open(bundle, 'rb') as read:
+            self.assertEqual(repacked, read.read())
+
+    def test_whenPipelineCombinedWithJobs_thenExceptionRaised(self):
+        self.assertRaises(Exception, self.build, '--pipeline', '--jobs', '2')
+
+    def test_whenBuiltWithProfile_thenSlowestNotesReported(self):
+        self.write_note('c.txt', '*golf*\nhotel\n    *india\n    juliett*\n    #kilo.png#\n')
+        with patch('sys.stdout', new_callable=StringIO.StringIO) as mock_stdout:
+            self.build('--profile', '--profile-top', '3')
+        lines = mock_stdout.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith('Profile: scan '))
+        self.assertTrue(lines[0].endswith(', 3 note(s) rendered'))
+        self.assertEqual(5, len(lines))
+        self.assertEqual([['5', '2', '1', '1', '52']], [line.split()[3:8] for line in lines if line.endswith('c.txt')])
+
+    def test_whenProfileDumpRequested_thenStatsWritten(self):
+        dump = os.path.join(self.dst_dir, 'build.pstats')
+        self.build('--profile-dump', dump)
+        self.assertTrue(pstats.Stats(dump).total_calls > 0)
+
+    @patch('sys.stdout')
+    def test_whenBuiltWithJobsAndNotesFail_thenErrorsReportedInPathOrder(self, mock_stdout):
+        for name in ['d.txt', 'c.txt', 'e.txt']:
+            self.write_note(name, '*bad*\n  bad\n')
+        self.build('--jobs', '2')
+        output = ''.join(call[0][0] for call in mock_stdout.write.call_args_list)
+        self.assertEqual(['c.txt', 'd.txt', 'e.txt'], re.findall(r'/(\w\.txt)\]', output))
+
+    @patch('sys.stdout')
+    def test_whenNotesFailWithFailFast_thenBuildStopsAtFirstError(self, mock_stdout):
+        for name in ['c.txt', 'd.txt']:
+            self.write_note(name, '*bad*\n  bad\n')
+        sys.argv = ['bin', '--fail-fast', self.src_dir, self.dst_dir]
+        self.assertEqual(1, run())
+        output = ''.join(call[0][0] for call in mock_stdout.write.call_args_list)
+        self.assertEqual(['c.txt'], re.findall(r'/(\w\.txt)\]', output))
+
+    @patch('sys.stdout')
+    def test_whenNotesFailWithFailFastAndJobs_thenPoolClosedBeforeManifestSaved(self, mock_stdout):
+        for name in ['c.txt', 'd.txt', 'e.txt']:
+            self.write_note(name, '*bad*\n  bad\n')
+        events = []
+        map_jobs_in_pool = notes2html.map_jobs_in_pool
+
+        def record_close(function, jobs, processes):
+            try:
+                for note in map_jobs_in_pool(function, jobs, processes):
+                    yield note
+            finally:
+                events.append('closed')
+        with patch('notes2html.map_jobs_in_pool', side_effect=record_close):
+            with patch('notes2html.save_manifest', side_effect=lambda *args: events.append('saved')):
+                self.build('--incremental', '--fail-fast', '--jobs', '2')
+        self.assertEqual(['closed', 'saved'], events)
+
+    @patch('sys.stdout')
+    def test_whenNoteSymlinkBroken_thenIoDiagnosticReportedAndOtherNotesBuilt(self, mock_stdout):
+        os.remove(os.path.join(self.src_dir, 'b.txt'))
+        os.symlink(os.path.join(self.src_dir, 'missing.txt'), os.path.join(self.src_dir, 'b.txt'))
+        for options in [{}, {'jobs': 2}, {'pipeline': True}, {'incremental': True}]:
+            diagnostics = build(self.src_dir, self.dst_dir, options)
+            self.assertEqual([(os.path.join(self.src_dir, 'b.txt'), 'io')], [(error['file'], error['rule']) for error in diagnostics])
+            self.assertIn('charlie', self.read_output('a.html'))
+        self.assertEqual([], [name for name in os.listdir(os.path.join(self.dst_dir, notes2html.AST_CACHE)) if name.endswith('.tmp')])
+
+    @patch('sys.stdout')
+    def test_whenNotesFail_thenErrorReportWritten(self, mock_stdout):
+        self.write_note('c.txt', '*bad*\nbravo\n    charlie\n  bad\n')
+        report = os.path.join(self.dst_dir, 'errors.json')
+        self.build('--keep-going', '--jobs', '2', '--error-report', report)
+        with open(report) as read:
+            errors = json.load(read)['errors']
+        self.assertEqual([{
+            'file': os.path.join(self.src_dir, 'c.txt'),
+            'line': 4,
+            'column': 3,
+            'rule': 'indentation',
+            'message': 'Unsupported number of spaces [2] in line [  bad]',
+        }], errors)
+        self.assertEqual(['a.html', 'b.html', 'errors.json'], sorted(os.listdir(self.dst_dir)))
+
+    def test_whenBuiltWithCompress_thenDeterministicGzipWrittenForChangedPages(self):
+        self.build('--compress', '--incremental')
+        gz_file = os.path.join(self.dst_dir, 'a.html.gz')
+        with open(gz_file, 'rb') as read:
+            compressed = read.read()
+        self.assertEqual('\x00\x00\x00\x00', compressed[4:8])
+        self.assertEqual(self.read_output('a.html'), gzip.GzipFile(gz_file).read())
+        os.remove(gz_file)
+        self.write_note('b.txt', '*delta*\necho\n    golf\n')
+        os.utime(os.path.join(self.src_dir, 'b.txt'), (0, 0))
+        with patch('notes2html.compress_output', wraps=notes2html.compress_output) as mock_compress:
+            self.build('--compress', '--incremental')
+            self.assertEqual([('a.html', False), ('b.html', True)], sorted((os.path.basename(call[0][0]), call[0][1]) for call in mock_compress.call_args_list))
+        with open(gz_file, 'rb') as read:
+            self.assertEqual(compressed, read.read())
+
+    @unittest.skipIf(brotli is None, 'brotli is not installed')
+    def test_whenBrotliAvailable_thenBrotliWritten(self):
+        self.build('--compress')
+        with open(os.path.join(self.dst_dir, 'a.html.br'), 'rb') as read:
+            self.assertEqual(self.read_output('a.html'), brotli.decompress(read.read()))
+
+    def test_whenTreeScanned_thenNotesInPathOrderWithAndWithoutScandir(self):
+        for name in ['a/b.txt', 'a-b.txt', 'a/c/d.txt', 'a/x.md', 'ab/e.txt']:
+            if not os.path.exists(os.path.dirname(os.path.join(self.src_dir, name))):
+                os.makedirs(os.path.dirname(os.path.join(self.src_dir, name)))
+            self.write_note(name, '*z*\ny\n    x\n')
+        expected = sorted(os.path.join(dp, f) for dp, dn, filenames in os.walk(self.src_dir) for f in filenames if f.endswith('.txt'))
+        self.assertEqual(expected, find_notes(self.src_dir))
+        with patch('notes2html.scandir', None):
+            self.assertEqual(expected, find_notes(self.src_dir))
+
+    def test_whenNotesIgnored_thenSkippedAndOutputsRemoved(self):
+        os.makedirs(os.path.join(self.src_dir, 'drafts'))
+        os.makedirs(os.path.join(self.src_dir, 'vendor', 'lib'))
+        self.write_note('drafts/c.txt', '*c*\nd\n    e\n')
+        self.write_note('vendor/lib/f.txt', '*f*\ng\n    h\n')
+        self.write_note('vendor/i.txt', '*i*\nj\n    k\n')
+        self.build('--incremental')
+        self.write_note('.notesignore', '# drafts and vendored notes\ndrafts/\n/vendor/lib\nb.txt\n')
+        self.build('--incremental')
+        self.assertEqual(['a.txt', 'vendor/i.txt'], [os.path.relpath(a_file, self.src_dir) for a_file in find_notes(self.src_dir)])
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'b.html')))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'drafts', 'c.html')))
+
+    def test_whenNotesShareOutputDirectory_thenDirectoryCreatedOnce(self):
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+        for name in ['c', 'd', 'e']:
+            self.write_note('sub/%s.txt' % name, '*%s*\nf\n    g\n' % name)
+        with patch('notes2html.os.makedirs', wraps=os.makedirs) as mock_makedirs:
+            self.build()
+            self.assertEqual(1, mock_makedirs.call_count)
+
+    def write_include(self):
+        os.makedirs(os.path.join(self.src_dir, 'parts'))
+        self.write_note('parts/shared.txt', 'shared entry\n')
+        self.write_note('.notesignore', 'parts/\n')
+        self.write_note('a.txt', '*alpha*\nbravo\n    #include parts/shared.txt#\n')
+
+    def test_whenNoteIncludesPartial_thenPartialExpandedWithIndentation(self):
+        self.write_include()
+        self.build()
+        self.assertIn('<li><span>shared entry</span></li>', self.read_output('a.html'))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'parts')))
+
+    def test_whenIncludedPartialChanged_thenOnlyDependentsRebuilt(self):
+        self.write_include()
+        self.build('--incremental')
+        self.write_note('parts/shared.txt', 'changed shared entry\n')
+        with patch('notes2html.parse_stream', wraps=notes2html.parse_stream) as mock_parse:
+            self.build('--incremental')
+            self.assertEqual(1, mock_parse.call_count)
+        self.assertIn('<li><span>changed shared entry</span></li>', self.read_output('a.html'))
+
+    def test_whenChangedFilesReadFromStdin_thenDependentsRebuiltWithoutScan(self):
+        self.write_include()
+        self.build('--incremental')
+        self.write_note('parts/shared.txt', 'changed shared entry\n')
+        with patch('sys.stdin', StringIO.StringIO(os.path.join(self.src_dir, 'parts', 'shared.txt') + '\nREADME.md\n')):
+            with patch('notes2html.scan_notes') as mock_scan:
+                self.build('--changed', '-')
+                self.assertFalse(mock_scan.called)
+        self.assertIn('<li><span>changed shared entry</span></li>', self.read_output('a.html'))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'parts')))
+
+    def test_whenNameStatusReadFromStdin_thenRenamedOutputsMovedAndDeletedRemoved(self):
+        self.build('--incremental')
+        os.rename(os.path.join(self.src_dir, 'a.txt'), os.path.join(self.src_dir, 'c.txt'))
+        os.remove(os.path.join(self.src_dir, 'b.txt'))
+        changes = 'R100\t%s\t%s\nD\t%s\n' % tuple(os.path.join(self.src_dir, name) for name in ('a.txt', 'c.txt', 'b.txt'))
+        with patch('sys.stdin', StringIO.StringIO(changes)):
+            with patch('notes2html.parse_stream') as mock_parse:
+                self.build('--since', '-')
+                self.assertFalse(mock_parse.called)
+        self.assertEqual(['c.html'], sorted(name for name in os.listdir(self.dst_dir) if name.endswith('.html')))
+        self.assertIn('alpha', self.read_output('c.html'))
+        self.assertEqual(['c.txt'], notes2html.load_manifest(self.dst_dir).keys())
+
+    def test_whenSinceRevision_thenOnlyGitChangesRebuilt(self):
+        git = ['git', '-c', 'user.name=notes', '-c', 'user.email=notes@localhost']
+        subprocess.check_call(git + ['init', '-q'], cwd=self.src_dir)
+        subprocess.check_call(git + ['add', '.'], cwd=self.src_dir)
+        subprocess.check_call(git + ['commit', '-q', '-m', 'notes'], cwd=self.src_dir)
+        self.build('--incremental')
+        self.write_note('a.txt', '*alpha*\nbravo\n    golf\n')
+        subprocess.check_call(git + ['mv', 'b.txt', 'd.txt'], cwd=self.src_dir)
+        with patch('notes2html.scan_notes') as mock_scan:
+            self.build('--since', 'HEAD')
+            self.assertFalse(mock_scan.called)
+        self.assertIn('golf', self.read_output('a.html'))
+        self.assertIn('delta', self.read_output('d.html'))
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'b.html')))
+
+    def test_whenSinceRevisionUnknown_thenExceptionRaised(self):
+        with self.assertRaisesRegexp(Exception, re.escape('Unable to read git changes since [HEAD]') + r'.*\[\S[^]]*HEAD'):
+            self.build('--since', 'HEAD')
+
+    def test_whenNestedNoteIncludesPartial_thenPathResolvedFromSourceDir(self):
+        self.write_include()
+        os.makedirs(os.path.join(self.src_dir, 'sub'))
+        self.write_note('sub/c.txt', '*charlie*\ndelta\n    #include parts/shared.txt#\n')
+        self.build()
+        self.assertIn('<li><span>shared entry</span></li>', self.read_output('sub/c.html'))
+
+    def test_whenChangedIncludeIsNotNote_thenDependentsRebuilt(self):
+        self.write_note('a.txt', '*alpha*\nbravo\n    #include shared.inc#\n')
+        self.write_note('shared.inc', 'shared entry\n')
+        self.build('--incremental')
+        self.write_note('shared.inc', 'changed shared entry\n')
+        with patch('sys.stdin', StringIO.StringIO(os.path.join(self.src_dir, 'shared.inc') + '\n')):
+            self.build('--changed', '-')
+        self.assertIn('<li><span>changed shared entry</span></li>', self.read_output('a.html'))
+
+    def test_whenChangedIncludeHasNonAsciiName_thenDependentsRebuilt(self):
+        self.write_note('a.txt', '*alpha*\nbravo\n    #include p\xc3\xa9.inc#\n')
+        self.write_note('p\xc3\xa9.inc', 'shared entry\n')
+        self.build('--incremental')
+        self.write_note('p\xc3\xa9.inc', 'changed shared entry\n')
+        with patch('sys.stdin', StringIO.StringIO(os.path.join(self.src_dir, 'p\xc3\xa9.inc') + '\n')):
+            self.build('--changed', '-')
+        self.assertIn('<li><span>changed shared entry</span></li>', self.read_output('a.html'))
+
+    def test_whenIncludeChangesWhileWatching_thenDependentsRebuiltWithoutManifest(self):
+        self.write_note('a.txt', '*alpha*\nbravo\n    #include shared.inc#\n')
+        self.write_note('shared.inc', 'shared entry\n')
+        graph = {}
+        build(self.src_dir, self.dst_dir, {}, graph=graph)
+        changes = iter_polled_changes(self.src_dir, 0.01, graph)
+        self.write_note('shared.inc', 'changed shared entry\n')
+        a_files = next(changes)
+        self.assertEqual([os.path.join(self.src_dir, 'shared.inc')], a_files)
+        build(self.src_dir, self.dst_dir, {}, a_files, graph=graph)
+        self.assertIn('<li><span>changed shared entry</span></li>', self.read_output('a.html'))
+
+    @patch('sys.stdout')
+    def test_whenErrorFollowsInclude_thenDiagnosticPointsAtSourceLine(self, mock_stdout):
+        self.write_note('parts.txt', 'one\ntwo\nthree\nfour\n')
+        self.write_note('.notesignore', 'parts.txt\n')
+        self.write_note('n.txt', '*november*\noscar\n    #include parts.txt#\n  bad\n')
+        self.write_note('p.txt', '*papa*\nquebec\n    #include q.inc#\n    romeo\n')
+        self.write_note('q.inc', 'sierra\n  bad\n')
+        report = os.path.join(self.dst_dir, 'errors.json')
+        self.build('--error-report', report)
+        with open(report) as read:
+            errors = json.load(read)['errors']
+        self.assertEqual([('n.txt', 4, 3, 'indentation'), ('p.txt', 3, 5, 'indentation')],
+                         [(os.path.basename(error['file']), error['line'], error['column'], error['rule']) for error in errors])
+
+    @patch('sys.stdout')
+    def test_whenIncludeCycle_thenDiagnosticPointsAtDirective(self, mock_stdout):
+        self.write_note('c.txt', '*charlie*\ndelta\n    echo\n    #include d.txt#\n')
+        self.write_note('d.txt', '    #include c.txt#\n')
+        report = os.path.join(self.dst_dir, 'errors.json')
+        self.build('--error-report', report)
+        with open(report) as read:
+            errors = json.load(read)['errors']
+        self.assertEqual([('c.txt', 4, 5, 'include_cycle'), ('d.txt', 1, 5, 'include_cycle')],
+                         [(os.path.basename(error['file']), error['line'], error['column'], error['rule']) for error in errors])
+
+    def test_whenUnknownOption_thenUsageErrorRaised(self):
+        with self.assertRaisesRegexp(Exception, re.escape('Unknown option --job. Usage: ')):
+            self.build('--job', '4')
+        self.assertEqual([], os.listdir(self.dst_dir))
+
+    def test_whenJobsHasNoValue_thenExceptionRaised(self):
+        self.assertRaises(Exception, self.build, '--jobs')
+
+    @patch('sys.stdout')
+    def test_whenNoteFails_thenNoOutputWritten(self, mock_stdout):
+        self.write_note('c.txt', '*bad*\n  bad\n')
+        self.build()
+        self.assertEqual(['a.html', 'b.html'], sorted(os.listdir(self.dst_dir)))
+
+    def test_whenNotesChangeWhilePolling_thenChangedNotesYielded(self):
+        changes = iter_polled_changes(self.src_dir, 0.01)
+        self.write_note('c.txt', '*golf*\nhotel\n    india\n')
+        os.remove(os.path.join(self.src_dir, 'a.txt'))
+        self.assertEqual([os.path.join(self.src_dir, 'a.txt'), os.path.join(self.src_dir, 'c.txt')], next(changes))
+
+    def test_whenNoteWrittenWhileWatchingWithInotify_thenNoteYielded(self):
+        changes = iter_inotify_changes(self.src_dir)
+        self.write_note('b.txt', '*delta*\necho\n    golf\n')
+        self.assertEqual([os.path.join(self.src_dir, 'b.txt')], next(changes))
+        changes.close()
+
+    def test_whenBuiltForChangedNotes_thenOnlyThoseNotesRendered(self):
+        self.build()
+        os.remove(os.path.join(self.src_dir, 'a.txt'))
+        self.write_note('c.txt', '*golf*\nhotel\n    india\n')
+        with patch('notes2html.parse_stream', side_effect=parse_stream) as mock_parse:
+            build(self.src_dir, self.dst_dir, {}, [os.path.join(self.src_dir, 'a.txt'), os.path.join(self.src_dir, 'c.txt')])
+            self.assertEqual(1, mock_parse.call_count)
+        self.assertEqual(['b.html', 'c.html'], sorted(os.listdir(self.dst_dir)))
+
+    def test_whenRebuiltWithoutChanges_thenOutputsNotTouched(self):
+        self.build()
+        os.utime(os.path.join(self.dst_dir, 'a.html'), (0, 0))
+        self.build()
+        self.assertEqual(0, os.stat(os.path.join(self.dst_dir, 'a.html')).st_mtime)
+
+    def test_whenTemplatesChanged_thenIncrementalBuildRendersAgain(self):
+        self.build('--incremental')
+        with patch.dict(TEMPLATES, {'entry': compile_template('<li>{{text}}</li>\n')}):
+            self.build('--incremental')
+        self.assertIn('<li>charlie</li>', self.read_output('a.html'))
+
+    def test_whenTemplatesChanged_thenNotesRenderedFromCachedAst(self):
+        self.build('--incremental')
+        with patch.dict(TEMPLATES, {'entry': compile_template('<li>{{text}}</li>\n')}):
+            with patch('notes2html.classify_line') as mock_classify:
+                self.build('--incremental')
+                self.assertFalse(mock_classify.called)
+        self.assertIn('<li>charlie</li>', self.read_output('a.html'))
+        self.assertEqual(2, len(os.listdir(os.path.join(self.dst_dir, '.notes2html.cache'))))
+
+    def test_whenNoteChanged_thenStaleAstRemovedFromCache(self):
+        self.build('--incremental')
+        self.write_note('b.txt', '*delta*\necho\n    golf\n')
+        os.utime(os.path.join(self.src_dir, 'b.txt'), (0, 0))
+        self.build('--incremental')
+        self.assertEqual(2, len(os.listdir(os.path.join(self.dst_dir, '.notes2html.cache'))))
+
+    def test_whenOutputChanged_thenOutputReplaced(self):
+        out_file = os.path.join(self.dst_dir, 'x.html')
+        for chunks, changed in [(['abc', 'def'], True), (['abc', 'def'], False), (['abc', 'xyz'], True), (['abc'], True), (['abcd'], True)]:
+            self.assertEqual(changed, write_if_changed(out_file, iter(chunks), hashlib.sha1()))
+            self.assertEqual(''.join(chunks), self.read_output('x.html'))
+        self.assertEqual(['x.html'], os.listdir(self.dst_dir))
+
+    def test_whenBuiltWithIndex_thenSiteIndexAndSearchIndexWritten(self):
+        self.build('--index')
+        self.assertIn('<a href=\'/a.html#bravo\'>bravo</a>', self.read_output('index.html'))
+        search_index = json.loads(self.read_output('search.json'))
+        self.assertEqual([['/a.html', 'alpha'], ['/b.html', 'delta']], search_index['notes'])
+        self.assertEqual([1], search_index['tokens']['echo'])
+
+    def test_whenOneNoteAddedToIndexedBuild_thenOnlyThatNoteTokenized(self):
+        self.build('--incremental', '--index')
+        self.write_note('c.txt', '*golf*\nhotel\n    india\n')
+        with patch('notes2html.tokenize', side_effect=notes2html.tokenize) as mock_tokenize:
+            self.build('--incremental', '--index')
+            self.assertEqual(1, mock_tokenize.call_count)
+        self.assertEqual([2], json.loads(self.read_output('search.json'))['tokens']['hotel'])
+
+    def test_whenNonAsciiTitleInIndexedBuild_thenSecondIncrementalBuildSucceeds(self):
+        self.write_note('c.txt', '*Caf\xc3\xa9*\nSection\n    x\n')
+        self.build('--incremental', '--index')
+        self.write_note('a.txt', '*alpha*\nkilo\n    lima\n')
+        self.build('--incremental', '--index')
+        self.assertIn('Caf\xc3\xa9', self.read_output('index.html'))
+        self.assertIn('kilo', self.read_output('index.html'))
+
+
+class AssetTest(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        self.dst_dir = tempfile.mkdtemp()
+        self.assets_dir = tempfile.mkdtemp()
+        self.write_asset('a.png', '\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' + struct.pack('>II', 3, 2) + '\x08\x02\x00\x00\x00')
+        self.write_asset('b.gif', 'GIF89a' + struct.pack('<HH', 5, 4) + '\x00\x00\x00')
+        self.write_asset('c.jpg', '\xff\xd8\xff\xe0' + struct.pack('>H', 4) + 'JF\xff\xc0' + struct.pack('>HBHH', 11, 8, 6, 7))
+        with open(os.path.join(self.src_dir, 'a.txt'), 'w') as write:
+            write.write('*alpha*\nbravo\n    #a.png#\n')
+        assets = dict(notes2html.ASSETS)
+        self.addCleanup(notes2html.ASSETS.update, assets)
+
+    def tearDown(self):
+        for directory in [self.src_dir, self.dst_dir, self.assets_dir]:
+            shutil.rmtree(directory)
+
+    def write_asset(self, name, data):
+        with open(os.path.join(self.assets_dir, name), 'wb') as write:
+            write.write(data)
+
+    def build(self, *options):
+        sys.argv = ['bin', '--assets', self.assets_dir] + list(options) + [self.src_dir, self.dst_dir]
+        return run()
+
+    def test_whenImageHeadersRead_thenDimensionsReturned(self):
+        sizes = [read_image_size(os.path.join(self.assets_dir, name)) for name in ['a.png', 'b.gif', 'c.jpg']]
+        self.assertEqual([(3, 2), (5, 4), (7, 6)], sizes)
+
+    def test_whenBuiltWithAssets_thenImagesCopiedAndSized(self):
+        self.build()
+        with open(os.path.join(self.dst_dir, 'a.html')) as read:
+            self.assertIn('<img class=\'imgbody\' src=\'/assets/a.png\' width=\'3\' height=\'2\' loading=\'lazy\'>', read.read())
+        self.assertEqual(['a.png', 'b.gif', 'c.jpg'], sorted(os.listdir(os.path.join(self.dst_dir, 'assets'))))
+        with patch('shutil.copy2') as mock_copy:
+            self.build()
+            self.assertFalse(mock_copy.called)
+
+    @patch('sys.stdout')
+    def test_whenImageMissingFromAssets_thenNoteFails(self, mock_stdout):
+        os.remove(os.path.join(self.assets_dir, 'a.png'))
+        self.assertEqual(1, self.build())
+        self.assertFalse(os.path.exists(os.path.join(self.dst_dir, 'a.html')))
+
+    @patch('sys.stdout')
+    def test_whenImageRemovedAfterIncrementalBuild_thenCachedNoteFails(self, mock_stdout):
+        self.assertEqual(0, self.build('--incremental'))
+        os.remove(os.path.join(self.assets_dir, 'a.png'))
+        report = os.path.join(self.dst_dir, 'errors.json')
+        self.assertEqual(1, self.build('--incremental', '--error-report', report))
+        with open(report) as read:
+            self.assertEqual(['missing_image'], [error['rule'] for error in json.load(read)['errors']])
+
+    def test_whenAssetsChangeAfterIncrementalBuild_thenOnlyReferencingNotesRendered(self):
+        with open(os.path.join(self.src_dir, 'b.txt'), 'w') as write:
+            write.write('*bravo*\ncharlie\n    #b.gif#\n')
+        self.build('--incremental')
+        self.write_asset('d.png', '\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' + struct.pack('>II', 1, 1) + '\x08\x02\x00\x00\x00')
+        with patch('notes2html.convert_note', side_effect=notes2html.convert_note) as mock_convert:
+            self.build('--incremental', '--assets', os.path.join(self.assets_dir, ''))
+            self.assertFalse(mock_convert.called)
+        self.write_asset('a.png', '\x89PNG\r\n\x1a\n\x00\x00\x00\x0dIHDR' + struct.pack('>II', 8, 9) + '\x08\x02\x00\x00\x00')
+        with patch('notes2html.convert_note', side_effect=notes2html.convert_note) as mock_convert:
+            self.build('--incremental')
+            self.assertEqual([os.path.join(self.src_dir, 'a.txt')], [call[0][0]['file'] for call in mock_convert.call_args_list])
+        with open(os.path.join(self.dst_dir, 'a.html')) as read:
+            self.assertIn('width=\'8\' height=\'9\'', read.read())
+
+    def test_whenFingerprinted_thenShellAssetsHashedAndReferenced(self):
+        self.write_asset('main.css', 'body {}')
+        self.build('--fingerprint', '--incremental')
+        with open(os.path.join(self.dst_dir, 'assets', 'manifest.json')) as read:
+            fingerprints = json.load(read)
+        css = 'main.%s.css' % hashlib.sha1('body {}').hexdigest()[:12]
+        self.assertEqual({'main.css': css}, fingerprints)
+        self.assertTrue(os.path.exists(os.path.join(self.dst_dir, 'assets', css)))
+        with open(os.path.join(self.dst_dir, 'a.html')) as read:
+            page = read.read()
+        self.assertIn('href="/assets/%s"' % css, page)
+        self.assertIn('src="/assets/syntaxhighlighter.js"', page)
+
+        with patch('notes2html.write_if_changed', wraps=notes2html.write_if_changed) as mock_write:
+            self.build('--fingerprint', '--incremental')
+            self.assertEqual([os.path.join(self.dst_dir, 'assets', 'manifest.json')], [call[0][0] for call in mock_write.call_args_list])
+        self.write_asset('main.css', 'body { margin: 0 }')
+        self.build('--fingerprint', '--incremental')
+        with open(os.path.join(self.dst_dir, 'a.html')) as read:
+            self.assertIn('href="/assets/main.%s.css"' % hashlib.sha1('body { margin: 0 }').hexdigest()[:12], read.read())
+
+    @unittest.skipIf(Image is None, 'PIL is not installed')
+    def test_whenThumbnailsRequested_thenWideImagesDownscaledOnce(self):
+        Image.new('RGB', (40, 20)).save(os.path.join(self.assets_dir, 'a.png'))
+        self.build('--thumbnails', '10')
+        with open(os.path.join(self.dst_dir, 'a.html')) as read:
+            self.assertIn('src=\'/assets/thumbs/a.png\' width=\'10\' height=\'5\'', read.read())
+        with patch('notes2html.make_thumbnail') as mock_thumbnail:
+            self.build('--thumbnails', '10')
+            self.assertFalse(mock_thumbnail.called)
+
+
+class PreviewServerTest(unittest.TestCase):
+    def setUp(self):
+        self.src_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.src_dir, 'a.txt'), 'w') as write:
+            write.write('*alpha*\nbravo\n    charlie\n')
+        self.server = make_server(self.src_dir, '127.0.0.1', 0, 1024 * 1024)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.src_dir)
+
+    def get(self, path, headers=None):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.getheader('ETag'), response.read()
+
+    def test_whenNoteRequested_thenRenderedPageServed(self):
+        status, etag, body = self.get('/a.html')
+        self.assertEqual(200, status)
+        self.assertEqual(parse(['*alpha*\n', 'bravo\n', '    charlie\n']), body)
+
+    def test_whenEtagMatches_thenNotModified(self):
+        status, etag, body = self.get('/a.html')
+        self.assertEqual(304, self.get('/a.html', {'If-None-Match': etag})[0])
+
+    def test_whenPathOutsideSourceOrMissing_thenNotFound(self):
+        self.assertEqual(404, self.get('/../a.html')[0])
+        self.assertEqual(404, self.get('/b.html')[0])
+        self.assertEqual(404, self.get('/a.txt')[0])
+
+
+class BundleServerTest(unittest.TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.bundle = os.path.join(self.work_dir, 'site.zip')
+        self.write_bundle({'a.html': '<p>alpha</p>', 'a.html.gz': 'gzipped alpha', 'dir/index.html': '<p>index</p>'})
+        self.server = make_bundle_server(self.bundle, '127.0.0.1', 0)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.work_dir)
+
+    def write_bundle(self, pages):
+        dst_dir = os.path.join(self.work_dir, 'out')
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        for name, page in pages.items():
+            if not os.path.isdir(os.path.dirname(os.path.join(dst_dir, name))):
+                os.makedirs(os.path.dirname(os.path.join(dst_dir, name)))
+            with open(os.path.join(dst_dir, name), 'w') as write:
+                write.write(page)
+        notes2html.write_bundle(dst_dir, self.bundle)
+
+    def get(self, path, headers=None):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1])
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, response.getheader('Content-Encoding'), response.getheader('ETag'), response.read()
+
+    def test_whenPageRequested_thenServedFromBundle(self):
+        self.assertEqual((200, None, '<p>alpha</p>'), self.get('/a.html')[:2] + self.get('/a.html')[3:])
+        self.assertEqual('<p>index</p>', self.get('/dir/')[3])
+        self.assertEqual(404, self.get('/b.html')[0])
+
+    def test_whenClientAcceptsGzip_thenCompressedEntryServed(self):
+        status, encoding, etag, body = self.get('/a.html', {'Accept-Encoding': 'gzip'})
+        self.assertEqual(('gzip', 'gzipped alpha'), (encoding, body))
+        self.assertEqual(304, self.get('/a.html', {'Accept-Encoding': 'gzip', 'If-None-Match': etag})[0])
+        self.assertEqual((None, '<p>alpha</p>'), self.get('/a.html', {'Accept-Encoding': 'br'})[1::2])
+
+    def test_whenBundleReplaced_thenNewPagesServed(self):
+        self.get('/a.html')
+        self.write_bundle({'a.html': '<p>alpha two</p>'})
+        self.assertEqual('<p>alpha two</p>', self.get('/a.html')[3])
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_whenCacheFull_thenLeastRecentlyUsedEvicted(self):
+        cache = LRUCache(10)
+        cache.put(('a', 1), 'a', 4)
+        cache.put(('b', 1), 'b', 4)
+        cache.get(('a', 1))
+        cache.put(('c', 1), 'c', 4)
+        self.assertEqual('a', cache.get(('a', 1)))
+        self.assertIsNone(cache.get(('b', 1)))
+        self.assertEqual('c', cache.get(('c', 1)))
+
+    def test_whenNewVersionCached_thenOldVersionDropped(self):
+        cache = LRUCache(10)
+        cache.put(('a', 1), 'old', 4)
+        cache.put(('a', 2), 'new', 4)
+        self.assertIsNone(cache.get(('a', 1)))
+        self.assertEqual(4, cache.size)